@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+
+# Micro-benchmark du transport Modbus : modbus_tk.RtuMaster vs transport PZEM intégré
+# Run as:
+# python3 bench/bench_codec.py [--reads 20000]
+#
+# Le port série est remplacé par un bouclage en mémoire qui répond instantanément :
+# seul le coût CPU côté maître (construction de la requête, CRC, décodage) est mesuré.
+
+import argparse
+import os
+import struct
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('PZEM2MQTT_CONFIG', os.path.join(ROOT, 'config.json.example'))
+
+import getPzemData as pzem  # noqa: E402
+
+
+class LoopbackSerial:
+    """Port série en mémoire qui répond immédiatement aux lectures 0x04 du PZEM"""
+
+    def __init__(self, baudrate=9600):
+        self.baudrate = baudrate
+        self.timeout = 1.0
+        self.inter_byte_timeout = None
+        self.is_open = True
+        self.name = 'loopback'
+        self._pending = b''
+        self._responses = {}
+
+    def _response(self, address):
+        response = self._responses.get(address)
+        if response is None:
+            pdu = struct.pack('>BB10H', 0x04, 20, 2301, 1500, 0, 3450, 0, 12345, 0, 500, 95, 0)
+            response = self._responses[address] = pzem.rtu_frame(address, pdu)
+        return response
+
+    def write(self, data):
+        self._pending = self._response(data[0])
+        return len(data)
+
+    def read(self, size=1):
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        pass
+
+    def reset_output_buffer(self):
+        pass
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+
+def run(transport, reads, addresses):
+    """Enchaîne les lectures et retourne (CPU par lecture, latences triées)"""
+    latencies = []
+    cpu_start = time.process_time()
+    for i in range(reads):
+        address = addresses[i % len(addresses)]
+        start = time.perf_counter()
+        registers = transport.read_input_registers(address, 1.0)
+        latencies.append(time.perf_counter() - start)
+        assert registers[0] == 2301
+    cpu = (time.process_time() - cpu_start) / reads
+    latencies.sort()
+    return cpu, latencies
+
+
+def report(name, cpu, latencies):
+    count = len(latencies)
+    print(f"{name:<12} CPU/lecture {cpu * 1e6:8.1f} µs   "
+          f"latence p50 {latencies[count // 2] * 1e6:8.1f} µs   "
+          f"p99 {latencies[int(count * 0.99)] * 1e6:8.1f} µs")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark des transports Modbus PZEM")
+    parser.add_argument('--reads', type=int, default=20000, help="Nombre de lectures par transport")
+    parser.add_argument('--sensors', type=int, default=4, help="Nombre d'adresses interrogées en alternance")
+    args = parser.parse_args()
+
+    addresses = list(range(1, args.sensors + 1))
+    transports = [
+        ('modbus_tk', pzem.ModbusTkTransport(LoopbackSerial(), 1.0)),
+        ('builtin', pzem.PzemRtuTransport(LoopbackSerial())),
+    ]
+
+    results = {}
+    for name, transport in transports:
+        run(transport, min(1000, args.reads), addresses)  # Chauffe
+        results[name] = run(transport, args.reads, addresses)
+        report(name, *results[name])
+
+    ratio = results['modbus_tk'][0] / results['builtin'][0]
+    print(f"Gain CPU du transport intégré : x{ratio:.1f}")
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+
+# Micro-benchmark de la mise en forme des lectures : coût CPU par lecture et octets MQTT
+# Run as:
+# python3 bench/bench_encoding.py [--reads 100000]
+#
+# "historique" reproduit l'ancien chemin (dict de 11 clés avec round/float, timezone()
+# à chaque lecture, isoformat x2, strftime x2, neuf chaînes de debug formatées puis
+# json.dumps) ; les autres lignes passent par PayloadEncoder. Les octets sur le fil
+# comptent un PUBLISH MQTT 3.1.1 QoS 0 complet (en-tête fixe, topic, payload).
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('PZEM2MQTT_CONFIG', os.path.join(ROOT, 'config.json.example'))
+
+import getPzemData as pzem  # noqa: E402
+from pytz import timezone  # noqa: E402
+
+SENSOR = {'unique_id': 'pzem_bureau', 'name': 'Bureau'}
+
+
+def registers():
+    """Jeu de registres PZEM plausibles"""
+    return [random.randint(2250, 2400), random.randint(0, 65535), 0, random.randint(0, 30000), 0,
+            random.randint(0, 65535), random.randint(0, 20), random.randint(498, 502), random.randint(50, 100), 0]
+
+
+def legacy(data):
+    """Ancien getPzem004t() + json.dumps de process(), debug désactivé"""
+    logger = logging.getLogger()
+    tension = round(data[0] / 10.0, 1)
+    courant = round((data[1] + (data[2] << 16)) / 1000.0, 3)
+    courant_ma = round(data[1] + (data[2] << 16), 0)
+    puissance = round((data[3] + (data[4] << 16)) / 10.0, 1)
+    energy = (data[5] + (data[6] << 16)) / 1000.0
+    index = (data[5] + (data[6] << 16))
+    frequency = data[7] / 10.0
+    facteurDePuiss = data[8] / 100.0
+    puissanceApparente = round(courant * tension, 2)
+    logger.debug("Index [Wh] : {0}".format(index))
+    logger.debug("Tension [V] : {0}".format(tension))
+    logger.debug("Courant [A] : {0}".format(courant))
+    logger.debug("Courant [mA] : {0}".format(courant_ma))
+    logger.debug("Puissance [W] : {0}".format(puissance))
+    logger.debug("Energy [kWh] : {0}".format(energy))
+    logger.debug("Frequency [Hz] : {0}".format(frequency))
+    logger.debug("Facteur de Puiss. [%] : {0}".format(facteurDePuiss))
+    logger.debug("Puissance Apparente [VA] : {0}".format(puissanceApparente))
+    reading_timestamp = datetime.now()
+    reading_timestamp_local = reading_timestamp.replace(tzinfo=timezone(pzem.local_tz))
+    payload = {
+        "current": float(courant),
+        "energy": float(energy),
+        "power": round(float(puissance), 1),
+        "voltage": float(tension),
+        "facteur_de_puiss": float(facteurDePuiss),
+        "frequency": float(frequency),
+        "apparent_power": float(puissanceApparente),
+        "timestamp": reading_timestamp.isoformat(),
+        "timestamp_local": reading_timestamp_local.isoformat(),
+        "last_read": reading_timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+        "last_read_local": reading_timestamp_local.strftime("%Y-%m-%d %H:%M:%S %Z")
+    }
+    return [(f"{pzem.base_topic}/{SENSOR['unique_id']}", json.dumps(payload))]
+
+
+def encoded(encoder):
+    """Nouveau chemin : valeurs brutes de getPzem004t() puis PayloadEncoder.encode()"""
+    def encode(data):
+        courant = (data[1] + (data[2] << 16)) / 1000.0
+        tension = data[0] / 10.0
+        reading = {
+            "current": courant,
+            "energy": (data[5] + (data[6] << 16)) / 1000.0,
+            "power": (data[3] + (data[4] << 16)) / 10.0,
+            "voltage": tension,
+            "facteur_de_puiss": data[8] / 100.0,
+            "frequency": data[7] / 10.0,
+            "apparent_power": round(courant * tension, 2),
+            "time": time.time()
+        }
+        return encoder.encode(SENSOR, reading)
+    return encode
+
+
+def wire_bytes(messages):
+    """Taille des PUBLISH QoS 0 : en-tête fixe + longueur restante + topic + payload"""
+    total = 0
+    for topic, payload in messages:
+        if isinstance(payload, str):
+            payload = payload.encode()
+        remaining = 2 + len(topic.encode()) + len(payload)
+        length_bytes = 1 if remaining < 128 else 2 if remaining < 16384 else 3
+        total += 1 + length_bytes + remaining
+    return total
+
+
+def run(encode, samples, reads):
+    """Encode les lectures et retourne (CPU par lecture, octets moyens par lecture)"""
+    size = 0
+    cpu_start = time.process_time()
+    for i in range(reads):
+        encode(samples[i % len(samples)])
+    cpu = (time.process_time() - cpu_start) / reads
+    for data in samples:
+        size += wire_bytes(encode(data))
+    return cpu, size / len(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark des formats de payload PZEM")
+    parser.add_argument('--reads', type=int, default=100000, help="Nombre de lectures encodées par format")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    samples = [registers() for _ in range(1000)]
+    zone = timezone(pzem.local_tz)
+
+    candidates = [('historique', legacy)]
+    for format in pzem.PayloadEncoder.FORMATS:
+        try:
+            candidates.append((format, encoded(pzem.PayloadEncoder(format, zone))))
+        except ImportError as e:
+            print(f"{format:<12} ignoré ({e})")
+
+    baseline = None
+    for name, encode in candidates:
+        run(encode, samples, min(5000, args.reads))  # Chauffe
+        cpu, size = run(encode, samples, args.reads)
+        baseline = baseline or cpu
+        print(f"{name:<12} CPU/lecture {cpu * 1e6:6.2f} µs  (x{baseline / cpu:4.1f})   "
+              f"{size:6.1f} octets MQTT/lecture")
+
+
+if __name__ == "__main__":
+
+    main()
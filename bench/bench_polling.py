@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+
+# Benchmark de bout en bout du polling : simulateur PZEM + broker MQTT de test
+# Run as:
+# python3 bench/bench_polling.py [--sizes 1,4,16,64] [--duration 10] [--driver builtin]
+#                                [--transport serial|rtu_tcp|modbus_tcp] [--gateways 1]
+#
+# Pour chaque taille, lance le(s) simulateur(s) et le broker dans des processus
+# séparés, puis pzem2mqtt dans un dernier processus qui interroge le(s) bus en
+# continu. Avec --gateways N, les capteurs sont répartis sur N bus (N pty ou N
+# passerelles TCP simulées) interrogés en parallèle. Résultats : durée d'un balayage complet du bus, lectures par seconde,
+# latence de publication (lecture -> réception par le broker) et CPU par lecture
+# du processus pzem2mqtt.
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+
+def write_config(path, mqtt_port, ports, sensors, driver, transport='serial'):
+    """Configuration pzem2mqtt pointant vers les simulateurs (un bus par port) et le broker de test"""
+    buses = {}
+    for index, port in enumerate(ports):
+        buses[f"bus{index}"] = {"transport": transport, "port": port, "baudrate": 9600, "timeout": 1.0, "driver": driver}
+        if transport != 'serial':
+            buses[f"bus{index}"]["host"] = "127.0.0.1"
+    config = {
+        "mqtt": {"host": "127.0.0.1", "port": mqtt_port, "auto_discovery": False,
+                 "discovery_topic": "homeassistant", "base_topic": "bench"},
+        "buses": buses,
+        # Intervalle quasi nul : le bus est interrogé en continu
+        "general": {"local_tz": "Europe/Paris", "poll_interval": 0.001, "log_level": "WARNING"},
+        "sensors": [{"device_id": index // len(ports) + 1, "unique_id": f"bench_{index + 1}", "name": f"Bench {index + 1}",
+                     "bus": f"bus{index % len(ports)}", "enabled": True}
+                    for index in range(sensors)]
+    }
+    with open(path, 'w') as f:
+        json.dump(config, f)
+
+
+def run_one(duration):
+    """Processus pzem2mqtt : polling pendant 'duration' secondes puis résultats en JSON"""
+    sys.path.insert(0, ROOT)
+    import paho.mqtt.client as mqtt
+    import getPzemData as pzem
+
+    async def run():
+        pzem.init_loop_state()
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        client.on_publish = pzem.on_publish
+        pzem.AsyncioMqttBridge(client, asyncio.get_running_loop())
+        client.connect(pzem.mqtt_host, pzem.mqtt_port)
+        for bus in pzem.build_buses():
+            pzem.open_bus(bus)
+            pzem.buses.append(bus)
+
+        cpu_start = time.process_time()
+        wall_start = time.monotonic()
+        for bus in pzem.buses:
+            pzem.start_bus(client, bus)
+        workers = asyncio.gather(pzem.publish_worker(client, pzem.publish_queue), *(bus['task'] for bus in pzem.buses))
+        try:
+            await asyncio.wait_for(workers, duration)
+        except asyncio.TimeoutError:
+            pass
+        elapsed = time.monotonic() - wall_start
+        cpu = time.process_time() - cpu_start
+        client.disconnect()
+        await asyncio.sleep(0.2)
+        return elapsed, cpu
+
+    elapsed, cpu = asyncio.run(run())
+    stats = pzem.error_stats
+    failures = stats['crc_errors'] + stats['timeout_errors'] + stats['other_errors']
+    json.dump({
+        "elapsed": elapsed,
+        "cpu": cpu,
+        "reads": stats['total_reads'],
+        "successful_reads": stats['total_reads'] - failures,
+        "polls": sum(bus['stats']['polls'] for bus in pzem.buses)
+    }, sys.stdout)
+
+
+def start_helper(args):
+    """Lance un processus auxiliaire qui affiche sa première ligne (port) sur stdout"""
+    process = subprocess.Popen([sys.executable] + args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return process, process.stdout.readline().strip()
+
+
+def bench_size(sensors, args):
+    gateways = min(args.gateways, sensors)
+    simulator_args = ['--latency', str(args.latency), '--crc-rate', str(args.crc_rate)]
+    if args.transport != 'serial':
+        simulator_args += ['--tcp-port', '0', '--protocol', 'modbus_tcp' if args.transport == 'modbus_tcp' else 'rtu']
+    simulators = []
+    ports = []
+    for index in range(gateways):
+        simulator, port = start_helper([os.path.join(BENCH_DIR, 'pzem_simulator.py'),
+                                        '--sensors', str(len(range(index, sensors, gateways)))] + simulator_args)
+        simulators.append(simulator)
+        ports.append(port if args.transport == 'serial' else int(port))
+    broker, mqtt_port = start_helper([os.path.join(BENCH_DIR, 'mqtt_standin.py'), '--port', '0', '--summary'])
+    try:
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as config_file:
+            config_path = config_file.name
+        write_config(config_path, int(mqtt_port), ports, sensors, args.driver, args.transport)
+        env = dict(os.environ, PZEM2MQTT_CONFIG=config_path)
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-one', str(args.duration)],
+                                env=env, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output)
+    finally:
+        broker.send_signal(signal.SIGTERM)
+        messages = json.loads(broker.communicate()[0] or '[]')
+        for simulator in simulators:
+            simulator.kill()
+            simulator.wait()
+        os.unlink(config_path)
+
+    # Latence de publication : horodatage de lecture -> réception par le broker
+    latencies = sorted(
+        message['received'] - datetime.fromisoformat(json.loads(message['payload'])['timestamp']).timestamp()
+        for message in messages if message['topic'].startswith('bench/bench_')
+    )
+    result['publish_latency_p50'] = latencies[len(latencies) // 2] if latencies else None
+    result['publish_latency_p99'] = latencies[int(len(latencies) * 0.99)] if latencies else None
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de bout en bout du polling pzem2mqtt")
+    parser.add_argument('--sizes', default='1,2,4,8,16,32,64', help="Nombres de capteurs à tester")
+    parser.add_argument('--duration', type=float, default=10.0, help="Durée de chaque mesure en secondes")
+    parser.add_argument('--driver', default='modbus_tk', choices=['modbus_tk', 'builtin'])
+    parser.add_argument('--latency', type=float, default=0.03, help="Temps de réponse simulé des capteurs")
+    parser.add_argument('--crc-rate', type=float, default=0.0, help="Proportion de réponses corrompues")
+    parser.add_argument('--transport', default='serial', choices=['serial', 'rtu_tcp', 'modbus_tcp'],
+                        help="Liaison vers les simulateurs : pty, RTU encapsulé dans TCP ou Modbus TCP")
+    parser.add_argument('--gateways', type=int, default=1, help="Nombre de bus (ou passerelles) entre lesquels répartir les capteurs")
+    parser.add_argument('--run-one', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one is not None:
+        run_one(args.run_one)
+        return
+
+    print(f"{'capteurs':>8} {'balayage (s)':>13} {'lectures/s':>11} {'succès %':>9} "
+          f"{'pub p50 (ms)':>13} {'pub p99 (ms)':>13} {'CPU/lecture (µs)':>17}")
+    for sensors in [int(size) for size in args.sizes.split(',')]:
+        result = bench_size(sensors, args)
+        sweeps = result['polls'] / sensors
+        sweep_time = result['elapsed'] / sweeps if sweeps else float('nan')
+        success = 100.0 * result['successful_reads'] / result['reads'] if result['reads'] else 0.0
+        p50 = result['publish_latency_p50']
+        p99 = result['publish_latency_p99']
+        print(f"{sensors:>8} {sweep_time:>13.3f} {result['successful_reads'] / result['elapsed']:>11.1f} {success:>9.1f} "
+              f"{(p50 or 0) * 1000:>13.1f} {(p99 or 0) * 1000:>13.1f} "
+              f"{result['cpu'] / max(1, result['reads']) * 1e6:>17.0f}")
+
+
+if __name__ == "__main__":
+
+    main()
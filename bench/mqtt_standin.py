@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+
+# Broker MQTT minimal (MQTT 3.1.1, QoS 0/1) pour les tests et benchmarks locaux
+# Run as:
+# python3 bench/mqtt_standin.py [--port 1883] [--summary]
+#
+# Accepte les connexions, acquitte les publications et les transmet aux
+# abonnés. Chaque publication reçue est capturée (heure d'arrivée, topic,
+# payload) ; avec --summary, la liste est écrite en JSON sur la sortie
+# standard à l'arrêt (SIGTERM / Ctrl-C). Le message de dernière volonté (LWT)
+# d'un client est publié si sa connexion se ferme sans DISCONNECT.
+
+import argparse
+import asyncio
+import json
+import signal
+import struct
+import sys
+import time
+
+
+def topic_matches(topic_filter, topic):
+    """Correspondance d'un topic avec un filtre MQTT (+ et #)"""
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for index, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if index >= len(topic_levels) or (level != '+' and level != topic_levels[index]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class MqttStandin:
+    """Broker MQTT minimal : CONNECT, PUBLISH (QoS 0/1), SUBSCRIBE, PINGREQ, DISCONNECT"""
+
+    def __init__(self):
+        self.messages = []      # (heure d'arrivée, topic, payload, qos, retain)
+        self.retained = {}
+        self.subscribers = []   # (writer, filtre)
+        self.server = None
+        self.port = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self._handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        self.server.close()
+        for writer, _ in self.subscribers:
+            writer.close()
+
+    @staticmethod
+    def _packet(header, body):
+        out = bytearray([header])
+        length = len(body)
+        while True:
+            byte = length % 128
+            length //= 128
+            out.append(byte | (0x80 if length else 0))
+            if not length:
+                break
+        return bytes(out) + body
+
+    @staticmethod
+    async def _read_packet(reader):
+        header = (await reader.readexactly(1))[0]
+        multiplier, length = 1, 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header, await reader.readexactly(length)
+
+    def _deliver(self, topic, payload, retain=False):
+        frame = self._packet(0x31 if retain else 0x30, struct.pack('>H', len(topic)) + topic.encode() + payload)
+        for writer, topic_filter in self.subscribers:
+            if topic_matches(topic_filter, topic):
+                writer.write(frame)
+
+    @staticmethod
+    def _parse_will(body):
+        """Message de dernière volonté d'un CONNECT : (topic, payload, retain) ou None"""
+        offset = 2 + struct.unpack_from('>H', body)[0] + 1  # Nom et niveau du protocole
+        flags = body[offset]
+        if not flags & 0x04:
+            return None
+        offset += 3  # Drapeaux et keepalive
+        fields = []
+        for _ in range(3):  # Identifiant client, topic et message de la volonté
+            length = struct.unpack_from('>H', body, offset)[0]
+            fields.append(body[offset + 2:offset + 2 + length])
+            offset += 2 + length
+        return fields[1].decode(), fields[2], bool(flags & 0x20)
+
+    def _publish(self, topic, payload, qos=0, retain=False):
+        self.messages.append((time.time(), topic, payload, qos, retain))
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        self._deliver(topic, payload)
+
+    async def _handle(self, reader, writer):
+        will = None
+        try:
+            while True:
+                header, body = await self._read_packet(reader)
+                kind = header >> 4
+                if kind == 1:       # CONNECT
+                    will = self._parse_will(body)
+                    writer.write(self._packet(0x20, b'\x00\x00'))
+                elif kind == 3:     # PUBLISH
+                    qos = (header >> 1) & 0x03
+                    retain = bool(header & 0x01)
+                    topic_length = struct.unpack_from('>H', body)[0]
+                    topic = body[2:2 + topic_length].decode()
+                    offset = 2 + topic_length
+                    if qos:
+                        writer.write(self._packet(0x40, body[offset:offset + 2]))
+                        offset += 2
+                    self._publish(topic, body[offset:], qos, retain)
+                elif kind == 8:     # SUBSCRIBE
+                    packet_id, offset, granted = body[:2], 2, b''
+                    while offset < len(body):
+                        filter_length = struct.unpack_from('>H', body, offset)[0]
+                        topic_filter = body[offset + 2:offset + 2 + filter_length].decode()
+                        offset += 3 + filter_length
+                        self.subscribers.append((writer, topic_filter))
+                        granted += b'\x00'
+                        for topic, payload in self.retained.items():
+                            if topic_matches(topic_filter, topic):
+                                writer.write(self._packet(0x31, struct.pack('>H', len(topic)) + topic.encode() + payload))
+                    writer.write(self._packet(0x90, packet_id + granted))
+                elif kind == 12:    # PINGREQ
+                    writer.write(self._packet(0xD0, b''))
+                elif kind == 14:    # DISCONNECT
+                    will = None
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.subscribers = [(w, f) for w, f in self.subscribers if w is not writer]
+            writer.close()
+            if will is not None:
+                self._publish(*will[:2], retain=will[2])
+
+
+async def serve(port, summary):
+    standin = MqttStandin()
+    await standin.start(port=port)
+    print(standin.port, flush=True)
+    sys.stderr.write(f"Broker MQTT de test à l'écoute sur 127.0.0.1:{standin.port}\n")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    await standin.stop()
+
+    if summary:
+        json.dump([
+            {"received": received, "topic": topic, "payload": payload.decode(errors='replace'), "qos": qos, "retain": retain}
+            for received, topic, payload, qos, retain in standin.messages
+        ], sys.stdout)
+        sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Broker MQTT minimal pour tests locaux")
+    parser.add_argument('--port', type=int, default=1883, help="Port d'écoute (0 : port libre)")
+    parser.add_argument('--summary', action='store_true', help="Écrire les messages reçus en JSON à l'arrêt")
+    args = parser.parse_args()
+    asyncio.run(serve(args.port, args.summary))
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+
+# Simulateur de bus PZEM-004T v3.0 sur un pseudo-terminal (pty)
+# Run as:
+# python3 bench/pzem_simulator.py --sensors 8 [--latency 0.03] [--crc-rate 0.01] [--dead 5,6]
+#
+# Le chemin du port série simulé est affiché au démarrage, il suffit de le
+# renseigner dans config.json (section serial) pour faire tourner pzem2mqtt
+# sans matériel. Fonctions supportées : lecture 0x04, remise à zéro de
+# l'énergie 0x42 et écriture de registre 0x06.
+#
+# Avec --tcp-port, le bus est servi comme derrière une passerelle Ethernet-RS485
+# (--protocol rtu : RTU encapsulé dans TCP façon ser2net, --protocol modbus_tcp :
+# Modbus TCP) ; le port TCP est alors affiché au démarrage. En Modbus TCP,
+# --gateway-exception 11 fait répondre la passerelle par l'exception 0x0B (ou 10 : 0x0A)
+# pour une adresse sans capteur, comme les passerelles du commerce.
+
+import argparse
+import os
+import pty
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import tty
+
+
+def crc16(data):
+    """CRC-16 Modbus"""
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+def with_crc(frame):
+    crc = crc16(frame)
+    return frame + bytes([crc & 0xFF, crc >> 8])
+
+
+# Longueur des requêtes par code fonction
+REQUEST_LENGTHS = {0x04: 8, 0x06: 8, 0x42: 4}
+
+
+class PzemSlave:
+    """Un PZEM-004T simulé : mesures légèrement bruitées et compteur d'énergie croissant"""
+
+    def __init__(self, address):
+        self.address = address
+        self.power_w = random.uniform(50, 3000)
+        self.energy_wh = random.randint(0, 500000)
+        self.alarm_threshold = 23000
+        self.last_update = time.monotonic()
+
+    def registers(self):
+        now = time.monotonic()
+        self.energy_wh += self.power_w * (now - self.last_update) / 3600.0
+        self.last_update = now
+        self.power_w = max(0.0, self.power_w * random.uniform(0.98, 1.02))
+
+        voltage = random.uniform(228.0, 232.0)
+        current_ma = int(self.power_w / voltage * 1000)
+        power = int(self.power_w * 10)
+        energy = int(self.energy_wh)
+        return (
+            int(voltage * 10),
+            current_ma & 0xFFFF, current_ma >> 16,
+            power & 0xFFFF, power >> 16,
+            energy & 0xFFFF, energy >> 16,
+            500,    # 50.0 Hz
+            95,     # Facteur de puissance 0.95
+            0       # Alarme
+        )
+
+
+class PzemSimulator:
+    """
+    Bus RS-485 simulé : un pty dont le côté esclave est ouvert par pzem2mqtt
+    comme un port série ordinaire, le côté maître étant servi par un thread.
+    Avec tcp_port, le bus est servi en TCP (un thread par connexion, une seule
+    transaction à la fois sur la ligne simulée).
+    """
+
+    def __init__(self, addresses, latency=0.03, crc_rate=0.0, dead=(), baudrate=9600, tcp_port=None, protocol='rtu',
+                 gateway_exception=0):
+        self.slaves = {address: PzemSlave(address) for address in addresses if address not in dead}
+        self.latency = latency
+        self.crc_rate = crc_rate
+        # Durée d'un caractère sur la ligne (0 : pas d'émulation du débit)
+        self.char_time = 11.0 / baudrate if baudrate else 0.0
+        self.stats = {'requests': 0, 'responses': 0, 'corrupted': 0, 'ignored': 0, 'connections': 0}
+        self.protocol = protocol
+        self.gateway_exception = gateway_exception
+        self._line = threading.Lock()
+        if tcp_port is None:
+            self._master, slave = pty.openpty()
+            tty.setraw(slave)
+            self._slave = slave
+            self.port = os.ttyname(slave)
+            self._listener = None
+            self._thread = threading.Thread(target=self._serve_pty, name="pzem-simulator", daemon=True)
+        else:
+            self._listener = socket.create_server(('127.0.0.1', tcp_port))
+            self.port = self._listener.getsockname()[1]
+            self._thread = threading.Thread(target=self._accept, name="pzem-simulator", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _handle(self, request):
+        address, function = request[0], request[1]
+        slave = self.slaves.get(address)
+        if slave is None:
+            return None
+        if function == 0x04:
+            return with_crc(struct.pack('>BBB10H', address, 0x04, 20, *slave.registers()))
+        if function == 0x42:
+            slave.energy_wh = 0
+            return with_crc(bytes([address, 0x42]))
+        if function == 0x06:
+            register, value = struct.unpack_from('>HH', request, 2)
+            if register == 0x0001:
+                slave.alarm_threshold = value
+            elif register == 0x0002 and 1 <= value <= 247:
+                del self.slaves[address]
+                slave.address = value
+                self.slaves[value] = slave
+            else:
+                return with_crc(bytes([address, 0x86, 0x02]))
+            return request
+        return with_crc(bytes([address, function | 0x80, 0x01]))
+
+    def _respond(self, request):
+        """Traite une requête RTU valide : réponse RTU, ou None si l'esclave ne répond pas"""
+        with self._line:
+            self.stats['requests'] += 1
+            response = self._handle(request)
+            if response is None:
+                return None
+
+            # Temps de traitement du PZEM puis émission au débit de la ligne
+            time.sleep(self.latency + (len(request) + len(response)) * self.char_time)
+            if self.crc_rate and random.random() < self.crc_rate:
+                response = response[:-1] + bytes([response[-1] ^ 0xFF])
+                self.stats['corrupted'] += 1
+            self.stats['responses'] += 1
+            return response
+
+    def _serve_pty(self):
+        self._serve_rtu(lambda: os.read(self._master, 256), lambda data: os.write(self._master, data))
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self._listener.accept()
+            except OSError:
+                return
+            self.stats['connections'] += 1
+            serve = self._serve_mbap if self.protocol == 'modbus_tcp' else self._serve_rtu_socket
+            threading.Thread(target=serve, args=(connection,), daemon=True).start()
+
+    def _serve_rtu_socket(self, connection):
+        with connection:
+            self._serve_rtu(lambda: connection.recv(256), connection.sendall)
+
+    def _serve_mbap(self, connection):
+        """Modbus TCP : l'en-tête MBAP remplace l'adresse et le CRC de la trame RTU"""
+        buffer = b''
+        with connection:
+            while True:
+                try:
+                    chunk = connection.recv(256)
+                except OSError:
+                    return
+                if not chunk:
+                    return
+                buffer += chunk
+
+                while len(buffer) >= 7:
+                    transaction, _, length, unit = struct.unpack_from('>HHHB', buffer)
+                    if len(buffer) < 6 + length:
+                        break
+                    pdu, buffer = buffer[7:6 + length], buffer[6 + length:]
+                    response = self._respond(with_crc(bytes([unit]) + pdu))
+                    if response is None:
+                        if not self.gateway_exception:
+                            continue
+                        # La passerelle répond elle-même après son propre délai d'attente de l'esclave
+                        time.sleep(self.latency)
+                        response = with_crc(bytes([unit, pdu[0] | 0x80, self.gateway_exception]))
+                    body = response[1:-2]
+                    connection.sendall(struct.pack('>HHHB', transaction, 0, len(body) + 1, unit) + body)
+
+    def _serve_rtu(self, receive, send):
+        buffer = b''
+        while True:
+            try:
+                chunk = receive()
+            except OSError:
+                return
+            if not chunk:
+                return
+            buffer += chunk
+
+            while len(buffer) >= 2:
+                length = REQUEST_LENGTHS.get(buffer[1])
+                if length is None:
+                    # Octet parasite : resynchronisation
+                    buffer = buffer[1:]
+                    self.stats['ignored'] += 1
+                    continue
+                if len(buffer) < length:
+                    break
+                request, buffer = buffer[:length], buffer[length:]
+                if crc16(request[:-2]) != request[-2] | (request[-1] << 8):
+                    self.stats['ignored'] += 1
+                    continue
+
+                response = self._respond(request)
+                if response is not None:
+                    send(response)
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.close()
+        else:
+            os.close(self._master)
+            os.close(self._slave)
+
+
+def parse_addresses(value):
+    return [int(address) for address in value.split(',') if address]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulateur de bus PZEM-004T v3.0")
+    parser.add_argument('--sensors', type=int, default=4, help="Nombre de capteurs (adresses 1 à N)")
+    parser.add_argument('--latency', type=float, default=0.03, help="Temps de réponse de chaque capteur en secondes")
+    parser.add_argument('--crc-rate', type=float, default=0.0, help="Proportion de réponses au CRC corrompu")
+    parser.add_argument('--dead', type=parse_addresses, default=[], help="Adresses qui ne répondent pas (ex. 3,7)")
+    parser.add_argument('--baudrate', type=int, default=9600, help="Débit émulé (0 pour désactiver)")
+    parser.add_argument('--tcp-port', type=int, help="Sert le bus en TCP sur ce port (0 : port libre) au lieu d'un pty")
+    parser.add_argument('--protocol', choices=['rtu', 'modbus_tcp'], default='rtu', help="Protocole TCP : RTU encapsulé ou Modbus TCP")
+    parser.add_argument('--gateway-exception', type=int, choices=[0, 10, 11], default=0,
+                        help="Modbus TCP : exception renvoyée par la passerelle pour une adresse muette (0 : aucune réponse)")
+    args = parser.parse_args()
+
+    simulator = PzemSimulator(range(1, args.sensors + 1), args.latency, args.crc_rate, args.dead, args.baudrate,
+                              args.tcp_port, args.protocol, args.gateway_exception).start()
+    print(simulator.port, flush=True)
+    sys.stderr.write(f"Simulateur PZEM : {len(simulator.slaves)} capteurs sur {simulator.port}\n")
+    try:
+        while True:
+            time.sleep(60)
+            sys.stderr.write(f"{simulator.stats}\n")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.close()
+
+
+if __name__ == "__main__":
+
+    main()
@@ -12,323 +12,2628 @@ import serial
 import modbus_tk.defines as cst
 from modbus_tk import modbus_rtu
 from modbus_tk.exceptions import ModbusError, ModbusInvalidResponseError
-import schedule
 import paho.mqtt.client as mqtt
 import logging
 import json
 import time
 import os
+import random
+import heapq
+import itertools
+import struct
+import collections
+import bisect
+import sqlite3
+import mmap
+import csv
+import sys
+import contextlib
+import hashlib
+import math
+from array import array
+import asyncio
+import signal
+import argparse
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from datetime import datetime
 from pytz import timezone
 
 
 # =================== Configuration Loading ===============================
+def config_path():
+    """Chemin du fichier de configuration (variable PZEM2MQTT_CONFIG, sinon config.json à côté du script)"""
+    return os.environ.get('PZEM2MQTT_CONFIG', os.path.join(os.path.dirname(__file__), 'config.json'))
+
 def load_config():
     """Charge la configuration depuis le fichier config.json"""
-    config_path = os.path.join(os.path.dirname(__file__), 'config.json')
+    path = config_path()
     try:
-        with open(config_path, 'r') as f:
+        with open(path, 'r') as f:
             return json.load(f)
     except FileNotFoundError:
-        print(f"Fichier de configuration {config_path} non trouvé")
+        print(f"Fichier de configuration {path} non trouvé")
         raise
     except json.JSONDecodeError as e:
         print(f"Erreur lors du parsing du fichier de configuration: {e}")
         raise
 
-# Chargement de la configuration
-config = load_config()
+# Chargement de la configuration
+config = load_config()
+
+# Configuration du logging avec le niveau depuis la configuration
+log_level = getattr(logging, config['general'].get('log_level', 'INFO').upper())
+logging.basicConfig(level=log_level, format='   %(asctime)s %(levelname)-8s %(message)s')
+logger = logging.getLogger()
+
+# Variables globales depuis la configuration
+mqtt_host = config['mqtt']['host']
+mqtt_port = config['mqtt']['port']
+auto_discovery = config['mqtt']['auto_discovery']
+discovery_topic = config['mqtt']['discovery_topic']
+base_topic = config['mqtt']['base_topic']
+local_tz = config['general']['local_tz']
+local_zone = timezone(local_tz)
+poll_interval = config['general']['poll_interval']
+publish_queue_size = config['mqtt'].get('queue_size', 1000)
+publish_queue_policy = config['mqtt'].get('queue_policy', 'coalesce')
+publish_max_inflight = config['mqtt'].get('max_inflight', 20)
+mqtt_connect_timeout = config['mqtt'].get('connect_timeout', 10)
+payload_format = config['mqtt'].get('payload_format', 'json')
+command_topic = base_topic + "/command"
+discovery_cache_path = config['mqtt'].get('discovery_cache', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'discovery_cache.json'))
+publish_config = config.get('publish', {})
+breaker_config = config.get('circuit_breaker', {})
+aggregation_config = config.get('aggregation', {})
+spool_config = config.get('spool', {})
+metrics_config = config.get('metrics', {})
+history_config = config.get('history', {})
+scan_config = config.get('scan', {})
+cluster_config = config.get('cluster', {})
+
+# Mode cluster : LWT, monitoring et résultat de scan propres à chaque nœud
+cluster_topic = base_topic + "/cluster"
+node_id = cluster_config.get('node_id', socket.gethostname().split('.')[0])
+node_topic = f"{cluster_topic}/{node_id}" if cluster_config.get('enabled', False) else base_topic
+lwt_topic = node_topic + "/lwt"
+monitoring_topic = node_topic + "/monitoring"
+monitoring_id = f"pzem2mqtt_{node_id}" if cluster_config.get('enabled', False) else "pzem2mqtt"
+
+# Statistiques d'erreurs pour le monitoring
+error_stats = {
+    'total_reads': 0,
+    'crc_errors': 0,
+    'timeout_errors': 0,
+    'other_errors': 0,
+    'consecutive_errors': 0,
+    'last_successful_read': None,
+    'last_monitoring_publish': None,
+    'session_start': datetime.now(),
+    'last_reads_by_sensor': {},  # Stockage des dernières lectures par capteur, clé (bus, device_id)
+    'published_messages': 0,
+    'suppressed_messages': 0,
+    'aggregates_published': 0
+}
+
+# Dernière valeur publiée par capteur (report-by-exception), clé unique_id
+last_published = {}
+
+# Tampons d'agrégation par capteur, clé unique_id
+aggregators = {}
+
+# Empreinte de la dernière configuration de découverte publiée, clé topic
+discovery_cache = {}
+
+# Spool disque des lectures produites pendant une coupure du broker
+spool = None
+
+# Historique local des lectures (section history)
+history = None
+
+# Appartenance au cluster (section cluster), None hors mode cluster
+cluster = None
+
+# Bus série actifs (une tâche asyncio de polling par bus)
+buses = []
+
+# Connexion MQTT établie (asyncio.Event positionné par on_connect, créé par init_loop_state)
+mqtt_connected = None
+
+# Jalons du démarrage, en secondes depuis le lancement du démon
+startup_stats = {
+    'started': time.monotonic(),
+    'buses_ready_s': None,
+    'mqtt_connected_s': None,
+    'first_publish_s': None
+}
+# ==================================================================
+
+
+class BusTiming:
+    """
+    Moteur de temporisation du bus Modbus RTU.
+
+    Remplace les délais fixes par des valeurs dérivées du bus :
+    - silence inter-trame t3.5 calculé depuis le baudrate
+    - timeout par capteur basé sur le temps de retournement mesuré
+    - backoff entre tentatives proportionnel au taux d'erreurs observé
+    """
+
+    REQUEST_FRAME_LEN = 8    # adresse + fonction + 4 octets + CRC
+    RESPONSE_FRAME_LEN = 25  # adresse + fonction + nb octets + 20 octets + CRC
+    EWMA_ALPHA = 0.2
+
+    def __init__(self, baudrate, min_timeout=0.1, max_timeout=3.0, max_backoff=1.0):
+        # Un caractère RTU = 11 bits (start + 8 données + parité/stop + stop)
+        self.char_time = 11.0 / baudrate
+        # Au-delà de 19200 bauds la norme fixe t3.5 à 1.75 ms
+        self.t35 = 3.5 * self.char_time if baudrate <= 19200 else 0.00175
+        self.wire_time = (self.REQUEST_FRAME_LEN + self.RESPONSE_FRAME_LEN) * self.char_time
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.max_backoff = max_backoff
+        self.turnaround = {}     # Temps de retournement moyen (EWMA) par capteur [s]
+        self.error_rate = 0.0    # Taux d'erreurs glissant (EWMA) sur le bus
+        self._last_frame_end = 0.0
+
+    async def wait_for_bus(self):
+        """Attend la fin du silence t3.5 depuis la dernière trame échangée"""
+        remaining = self._last_frame_end + self.t35 - time.monotonic()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+
+    def timeout_for(self, device_id):
+        """Timeout de réponse adapté au capteur (max_timeout tant qu'il n'a jamais répondu)"""
+        turnaround = self.turnaround.get(device_id)
+        if turnaround is None:
+            return self.max_timeout
+        timeout = self.wire_time + 3 * turnaround + self.t35
+        return min(self.max_timeout, max(self.min_timeout, timeout))
+
+    def record_success(self, device_id, elapsed):
+        """Met à jour le retournement mesuré et le taux d'erreurs après une lecture réussie"""
+        measured = max(0.0, elapsed - self.wire_time)
+        previous = self.turnaround.get(device_id)
+        self.turnaround[device_id] = measured if previous is None else previous + self.EWMA_ALPHA * (measured - previous)
+        self.error_rate -= self.EWMA_ALPHA * self.error_rate
+        self._last_frame_end = time.monotonic()
+
+    def record_failure(self, device_id):
+        """Met à jour le taux d'erreurs après une lecture en échec"""
+        self.error_rate += self.EWMA_ALPHA * (1.0 - self.error_rate)
+        # Réponse peut-être trop lente pour le timeout courant : on l'élargit pour la prochaine tentative
+        if device_id in self.turnaround:
+            self.turnaround[device_id] = min(self.max_timeout, self.turnaround[device_id] * 2)
+        self._last_frame_end = time.monotonic()
+
+    def release(self):
+        """Fin d'un échange hors lecture (commande) : point de départ du silence t3.5"""
+        self._last_frame_end = time.monotonic()
+
+    def backoff(self, attempt):
+        """Délai avant la tentative suivante : quasi nul sur un bus sain, croissant si le bus est perturbé"""
+        delay = min(self.max_backoff, self.error_rate * self.max_backoff * (2 ** attempt))
+        return self.t35 + delay * random.uniform(0.5, 1.0)
+
+    def stats(self):
+        """Résumé de la temporisation pour le monitoring"""
+        return {
+            "t35_ms": round(self.t35 * 1000, 3),
+            "error_rate": round(self.error_rate, 3),
+            "turnaround_ms": {f"sensor_{k}": round(v * 1000, 1) for k, v in self.turnaround.items()}
+        }
+
+
+class CircuitBreaker:
+    """
+    Disjoncteur par capteur : après plusieurs lectures en échec, le capteur n'est
+    plus interrogé (ouvert) puis seulement sondé de temps en temps (semi-ouvert)
+    par une tentative unique à timeout court, avec un délai entre sondes qui
+    double à chaque nouvel échec.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=3, open_base=30.0, open_max=600.0):
+        self.failure_threshold = failure_threshold
+        self.open_base = open_base
+        self.open_max = open_max
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.trips = 0           # Ouvertures successives sans lecture réussie
+        self.open_until = 0.0
+        self.skipped_polls = 0
+
+    def current_state(self, now):
+        """État du disjoncteur, passage en semi-ouvert à l'expiration du délai"""
+        if self.state == self.OPEN and now >= self.open_until:
+            self.state = self.HALF_OPEN
+        return self.state
+
+    def record_success(self):
+        """Lecture réussie : le disjoncteur se referme"""
+        previous = self.state
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.trips = 0
+        return previous != self.CLOSED
+
+    def record_failure(self, now):
+        """Lecture en échec : ouverture au seuil, ou réouverture avec un délai doublé après une sonde"""
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.trips += 1
+            self.state = self.OPEN
+            self.open_until = now + min(self.open_max, self.open_base * 2 ** (self.trips - 1))
+            return True
+        return False
+
+    def stats(self, now):
+        """État du disjoncteur pour le monitoring"""
+        return {
+            "state": self.current_state(now),
+            "consecutive_failures": self.consecutive_failures,
+            "trips": self.trips,
+            "skipped_polls": self.skipped_polls,
+            "next_probe_in_s": round(max(0.0, self.open_until - now), 1) if self.state == self.OPEN else None
+        }
+
+def make_breaker():
+    """Disjoncteur configuré depuis la section 'circuit_breaker'"""
+    return CircuitBreaker(
+        failure_threshold=breaker_config.get('failure_threshold', 3),
+        open_base=breaker_config.get('open_base', 30.0),
+        open_max=breaker_config.get('open_max', 600.0)
+    )
+
+class Histogram:
+    """Histogramme à seaux fixes, mis à jour depuis la boucle asyncio (sans verrou)"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsRegistry:
+    """
+    Métriques exposées au format Prometheus / OpenMetrics : histogrammes et
+    compteurs étiquetés, jauges calculées au moment de l'export.
+    """
+
+    RTT_BUCKETS = (0.01, 0.02, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0, 2.0, 3.0)
+    ATTEMPT_BUCKETS = (1, 2, 3, 5)
+    DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        self.help = {}
+        self.histograms = {}   # nom -> {étiquettes: Histogram}
+        self.counters = {}     # nom -> {étiquettes: valeur}
+        self.gauges = {}       # nom -> fonction retournant [(étiquettes, valeur)]
+
+    def histogram(self, name, labels, buckets):
+        series = self.histograms.setdefault(name, {})
+        histogram = series.get(labels)
+        if histogram is None:
+            histogram = series[labels] = Histogram(buckets)
+        return histogram
+
+    def observe(self, name, labels, value, buckets):
+        self.histogram(name, labels, buckets).observe(value)
+
+    def inc(self, name, labels, value=1):
+        series = self.counters.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + value
+
+    def gauge(self, name, collect, help_text):
+        self.gauges[name] = collect
+        self.help[name] = help_text
+
+    @staticmethod
+    def _escape(value):
+        """Échappement d'une valeur d'étiquette (antislash, guillemet, saut de ligne)"""
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @classmethod
+    def _labels(cls, labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{cls._escape(value)}"' for key, value in pairs) + '}'
+
+    def render(self):
+        """Export texte au format d'exposition Prometheus"""
+        lines = []
+        for name, series in self.counters.items():
+            lines.append(f"# HELP {name} {self.help.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in series.items():
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        for name, series in self.histograms.items():
+            lines.append(f"# HELP {name} {self.help.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {histogram.count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+        for name, collect in self.gauges.items():
+            lines.append(f"# HELP {name} {self.help.get(name, name)}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in collect():
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+metrics.help.update({
+    'pzem_modbus_rtt_seconds': "Durée aller-retour d'une transaction Modbus réussie",
+    'pzem_read_attempts': "Nombre de tentatives par lecture réussie",
+    'pzem_reads_total': "Transactions Modbus par résultat",
+    'pzem_poll_duration_seconds': "Durée de lecture et publication d'un capteur sur le bus",
+    'pzem_publish_latency_seconds': "Délai entre la mise en file d'une publication MQTT et son acquittement",
+    'pzem_publish_queue_total': "Messages supprimés ou fusionnés par la file de publication",
+    'pzem_commands_total': "Commandes capteur exécutées par action et résultat",
+})
+
+def _build_crc_table():
+    """Table de CRC-16 Modbus (polynôme 0xA001)"""
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+CRC16_TABLE = _build_crc_table()
+
+def crc16(data):
+    """CRC-16 Modbus calculé par table"""
+    crc = 0xFFFF
+    table = CRC16_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+def rtu_frame(address, pdu):
+    """Construit une trame RTU : adresse + PDU + CRC (octet de poids faible en premier)"""
+    frame = bytes([address]) + pdu
+    crc = crc16(frame)
+    return frame + bytes([crc & 0xFF, crc >> 8])
+
+class PzemTimeoutError(Exception):
+    """Réponse absente ou incomplète avant le timeout"""
+
+    def __init__(self, message, received=0):
+        super().__init__(message)
+        self.received = received  # Octets reçus avant le timeout (0 : aucun esclave n'a répondu)
+
+def rtu_echo_transaction(serial_connection, address, pdu):
+    """
+    Transaction d'écriture PZEM (0x06 écriture de registre, 0x42 remise à zéro de l'énergie) :
+    l'esclave renvoie la requête à l'identique, ou une réponse d'exception de 5 octets.
+    """
+    frame = rtu_frame(address, pdu)
+    serial_connection.reset_input_buffer()
+    serial_connection.write(frame)
+
+    response = serial_connection.read(2)
+    if len(response) == 2 and response[1] & 0x80:
+        response += serial_connection.read(3)
+        if len(response) != 5 or crc16(response[:3]) != response[3] | (response[4] << 8):
+            raise ModbusInvalidResponseError("Invalid CRC in response")
+        raise ModbusError(response[2])
+
+    response += serial_connection.read(len(frame) - len(response))
+    if len(response) != len(frame):
+        raise PzemTimeoutError(f"timeout: {len(response)}/{len(frame)} octets reçus", len(response))
+    if response != frame:
+        raise ModbusInvalidResponseError(f"Unexpected response {response.hex()} to {frame.hex()}")
+    return response
+
+class ModbusTkTransport:
+    """Transport générique basé sur modbus_tk.RtuMaster"""
+
+    def __init__(self, serial_connection, timeout):
+        self.serial = serial_connection
+        self.master = modbus_rtu.RtuMaster(serial_connection)
+        self.master.set_timeout(timeout)
+        self.master.set_verbose(True)
+
+        try:
+            self.master.close()
+        except:
+            pass
+
+    def read_input_registers(self, address, timeout):
+        """Lecture des 10 registres d'entrée du PZEM (transaction bloquante)"""
+        self.master.set_timeout(timeout)
+        return self.master.execute(address, cst.READ_INPUT_REGISTERS, 0, 10)
+
+    def write_command(self, address, pdu, timeout):
+        """Commande d'écriture (transaction bloquante) ; modbus_tk ne connaît pas la fonction 0x42"""
+        self.master.set_timeout(timeout)
+        return rtu_echo_transaction(self.serial, address, pdu)
+
+    def open(self):
+        self.master.open()
+
+    def close(self):
+        self.master.close()
+
+class PzemRtuTransport:
+    """
+    Transport PZEM-004T intégré, limité à la seule requête utilisée (fonction 0x04,
+    registres 0 à 9) : trames de requête précalculées par adresse, CRC par table,
+    réponse lue dans un tampon réutilisé et décodée en un seul struct.unpack_from.
+    """
+
+    RESPONSE_LEN = 25    # adresse + fonction + nb octets (20) + 10 registres + CRC
+    EXCEPTION_LEN = 5    # adresse + fonction | 0x80 + code d'exception + CRC
+    REGISTERS = struct.Struct('>10H')
+    READ_PDU = struct.pack('>BHH', cst.READ_INPUT_REGISTERS, 0, 10)
+
+    def __init__(self, serial_connection):
+        self.serial = serial_connection
+        self._frames = {}
+        self._buffer = bytearray(self.RESPONSE_LEN)
+        self._view = memoryview(self._buffer)
+
+    def request_frame(self, address):
+        """Trame de lecture précalculée pour une adresse"""
+        frame = self._frames.get(address)
+        if frame is None:
+            frame = self._frames[address] = rtu_frame(address, self.READ_PDU)
+        return frame
+
+    def _set_timeout(self, timeout):
+        # Arrondi à 10 ms : chaque changement reconfigure le port (appel termios). Comparé au
+        # timeout courant du flux, que les bus d'une même passerelle TCP se partagent
+        timeout = round(timeout, 2)
+        if timeout != self.serial.timeout:
+            self.serial.timeout = timeout
+
+    def _read_exactly(self, start, end):
+        """Remplit buffer[start:end], lève PzemTimeoutError si la réponse est incomplète"""
+        received = self.serial.readinto(self._view[start:end])
+        if received != end - start:
+            raise PzemTimeoutError(f"timeout: {start + received}/{end} octets reçus", start + received)
+
+    def read_input_registers(self, address, timeout):
+        """Lecture des 10 registres d'entrée du PZEM (transaction bloquante)"""
+        self._set_timeout(timeout)
+        self.serial.reset_input_buffer()
+        self.serial.write(self.request_frame(address))
+
+        buffer = self._buffer
+        # Les 5 premiers octets suffisent à reconnaître une réponse d'exception
+        self._read_exactly(0, self.EXCEPTION_LEN)
+        if buffer[1] & 0x80:
+            if crc16(self._view[:3]) != buffer[3] | (buffer[4] << 8):
+                raise ModbusInvalidResponseError("Invalid CRC in response")
+            raise ModbusError(buffer[2])
+
+        self._read_exactly(self.EXCEPTION_LEN, self.RESPONSE_LEN)
+        if crc16(self._view[:23]) != buffer[23] | (buffer[24] << 8):
+            raise ModbusInvalidResponseError("Invalid CRC in response")
+        if buffer[0] != address or buffer[1] != cst.READ_INPUT_REGISTERS or buffer[2] != 20:
+            raise ModbusInvalidResponseError(f"Unexpected response header {bytes(buffer[:3]).hex()} for address {address}")
+
+        return self.REGISTERS.unpack_from(buffer, 3)
+
+    def write_command(self, address, pdu, timeout):
+        """Commande d'écriture (transaction bloquante)"""
+        self._set_timeout(timeout)
+        return rtu_echo_transaction(self.serial, address, pdu)
+
+    def open(self):
+        if not self.serial.is_open:
+            self.serial.open()
+
+    def close(self):
+        if self.serial.is_open:
+            self.serial.close()
+
+class TcpStream:
+    """
+    Connexion TCP persistante vers une passerelle (ser2net, convertisseur Ethernet-RS485),
+    présentée avec l'interface pyserial utilisée par les transports : timeout, write,
+    read, readinto, reset_input_buffer. Reconnexion à la demande avec backoff exponentiel.
+    """
+
+    def __init__(self, host, port, timeout, connect_timeout=3.0, max_backoff=30.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_backoff = max_backoff
+        self.sock = None
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        self.stats = {'connects': 0, 'failures': 0}
+
+    @property
+    def is_open(self):
+        return self.sock is not None
+
+    def open(self):
+        """Connexion à la passerelle, refusée tant que le délai de backoff n'est pas écoulé"""
+        if self.sock is not None:
+            return
+        now = time.monotonic()
+        if now < self._retry_at:
+            raise ConnectionError(f"passerelle {self.host}:{self.port} injoignable, nouvelle tentative dans {self._retry_at - now:.1f}s")
+        try:
+            sock = socket.create_connection((self.host, self.port), self.connect_timeout)
+        except OSError:
+            self.stats['failures'] += 1
+            self._backoff = min(self.max_backoff, max(1.0, self._backoff * 2))
+            self._retry_at = now + self._backoff
+            raise
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self._backoff = 0.0
+        self.stats['connects'] += 1
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _connection(self):
+        if self.sock is None:
+            self.open()
+        return self.sock
+
+    def write(self, data):
+        try:
+            self._connection().sendall(data)
+        except OSError:
+            # Connexion rompue : elle sera rouverte à la prochaine transaction
+            self.close()
+            raise
+        return len(data)
+
+    def readinto(self, view):
+        """Remplit view jusqu'au timeout ; retourne le nombre d'octets reçus"""
+        sock = self._connection()
+        deadline = time.monotonic() + self.timeout
+        received = 0
+        while received < len(view):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                count = sock.recv_into(view[received:])
+            except socket.timeout:
+                break
+            except OSError:
+                self.close()
+                raise
+            if count == 0:
+                # Fermeture par la passerelle
+                self.close()
+                break
+            received += count
+        return received
+
+    def read(self, size):
+        buffer = bytearray(size)
+        return bytes(buffer[:self.readinto(memoryview(buffer))])
+
+    def reset_input_buffer(self):
+        """Purge les octets en attente (réponse tardive à une requête précédente)"""
+        sock = self._connection()
+        sock.setblocking(False)
+        try:
+            while True:
+                if not sock.recv(4096):
+                    self.close()
+                    break
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self.close()
+            raise
+        finally:
+            if self.sock is not None:
+                sock.setblocking(True)
+
+class ModbusTcpTransport:
+    """
+    Transport Modbus TCP vers une passerelle Ethernet-RS485 : en-tête MBAP à la place
+    de l'adresse et du CRC, l'identifiant d'unité désignant l'esclave sur la ligne.
+    """
+
+    MBAP = struct.Struct('>HHHB')   # transaction, protocole (0), longueur, unité
+    # Exceptions émises par la passerelle pour une unité absente : 0x0A chemin indisponible,
+    # 0x0B l'esclave n'a pas répondu
+    GATEWAY_EXCEPTIONS = (0x0A, 0x0B)
+    REGISTERS = struct.Struct('>10H')
+    READ_PDU = struct.pack('>BHH', cst.READ_INPUT_REGISTERS, 0, 10)
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._transaction = itertools.count(1)
+
+    def _read_exactly(self, size):
+        data = self.stream.read(size)
+        if len(data) != size:
+            raise PzemTimeoutError(f"timeout: {len(data)}/{size} octets reçus", len(data))
+        return data
+
+    def _transact(self, address, pdu, timeout):
+        """Envoie une PDU à l'unité address et retourne la PDU de réponse"""
+        self.stream.timeout = timeout
+        transaction = next(self._transaction) & 0xFFFF
+        self.stream.reset_input_buffer()
+        self.stream.write(self.MBAP.pack(transaction, 0, len(pdu) + 1, address) + pdu)
+
+        response_transaction, protocol, length, unit = self.MBAP.unpack(self._read_exactly(self.MBAP.size))
+        if response_transaction != transaction or protocol != 0 or unit != address or not 2 <= length <= 254:
+            raise ModbusInvalidResponseError(f"Unexpected MBAP header (transaction {response_transaction}/{transaction}, unit {unit})")
+        response = self._read_exactly(length - 1)
+        if response[0] & 0x80:
+            raise ModbusError(response[1])
+        return response
+
+    def read_input_registers(self, address, timeout):
+        """Lecture des 10 registres d'entrée du PZEM (transaction bloquante)"""
+        response = self._transact(address, self.READ_PDU, timeout)
+        if response[0] != cst.READ_INPUT_REGISTERS or response[1] != 20 or len(response) != 22:
+            raise ModbusInvalidResponseError(f"Unexpected response {response[:2].hex()} for address {address}")
+        return self.REGISTERS.unpack_from(response, 2)
+
+    def write_command(self, address, pdu, timeout):
+        """Commande d'écriture (transaction bloquante) : réponse identique à la requête"""
+        response = self._transact(address, pdu, timeout)
+        if response != pdu:
+            raise ModbusInvalidResponseError(f"Unexpected response {response.hex()} to {pdu.hex()}")
+        return response
+
+    def open(self):
+        self.stream.open()
+
+    def close(self):
+        self.stream.close()
+
+# Passerelles TCP ouvertes, clé (hôte, port) : une connexion persistante et un thread
+# par passerelle, partagés par les bus qui la désignent
+gateways = {}
+gateways_lock = threading.Lock()
+
+def acquire_gateway(bus):
+    """Connexion et thread de la passerelle du bus, créés au premier bus qui la désigne"""
+    key = (bus['host'], bus['tcp_port'])
+    with gateways_lock:
+        gateway = gateways.get(key)
+        if gateway is None:
+            gateway = gateways[key] = {
+                'stream': TcpStream(bus['host'], bus['tcp_port'], bus['timeout']),
+                'executor': ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"gw-{bus['host']}:{bus['tcp_port']}"),
+                'buses': set()
+            }
+        gateway['buses'].add(bus['name'])
+    return gateway
+
+def release_gateway(bus):
+    """Retire le bus de sa passerelle ; retourne True si plus aucun bus ne l'utilise"""
+    key = (bus['host'], bus['tcp_port'])
+    with gateways_lock:
+        gateway = gateways[key]
+        gateway['buses'].discard(bus['name'])
+        if gateway['buses']:
+            return False
+        del gateways[key]
+        return True
+
+def on_connect(client, userdata, flags, reason_code, properties=None):
+    """ Connection MQTT handler"""
+
+    global lwt_topic
+    logger.info("Connected to MQTT server with result code " + str(reason_code))
+    if reason_code.is_failure:
+        return
+
+    client.publish(lwt_topic, "online", qos=1, retain=True)
+    client.subscribe(f"{command_topic}/reload", qos=1)
+    client.subscribe(f"{command_topic}/scan", qos=1)
+    client.subscribe(f"{command_topic}/+/+", qos=1)
+    client.subscribe(f"{discovery_topic}/status", qos=1)
+    if cluster is not None:
+        client.subscribe(f"{cluster_topic}/+/lease", qos=1)
+        client.subscribe(f"{cluster_topic}/+/lwt", qos=1)
+        # Bail republié sans attendre le prochain heartbeat
+        cluster.announce = True
+        cluster.changed.set()
+
+    # Découverte publiée une fois la session établie (à chaque reconnexion, les configs sont retenues)
+    setup_discovery_configs(client)
+
+    if startup_stats['mqtt_connected_s'] is None:
+        startup_stats['mqtt_connected_s'] = round(time.monotonic() - startup_stats['started'], 3)
+        logger.info(f"Connecté au broker MQTT {startup_stats['mqtt_connected_s']}s après le démarrage")
+    mqtt_connected.set()
+
+def build_buses(include_empty=False, source=None):
+    """
+    Construit la liste des bus série et y répartit les capteurs activés (include_empty : bus sans capteur inclus).
+    source : configuration à utiliser, la configuration courante par défaut (un rechargement est validé
+    avant d'être appliqué). Lève ValueError si un bus n'a pas les paramètres de connexion de son transport.
+    """
+    source = config if source is None else source
+    buses = {}
+
+    # Bus historique défini par la section 'serial'
+    serial_config = source.get('serial', {})
+    if serial_config.get('port'):
+        buses['default'] = {'name': 'default', 'link': 'serial', 'port': serial_config['port'],
+                            'baudrate': serial_config.get('baudrate', 9600), 'timeout': serial_config.get('timeout', 3.0),
+                            'driver': serial_config.get('driver', 'modbus_tk')}
+
+    # Bus supplémentaires : un adaptateur USB-RS485 par bus, ou une passerelle TCP
+    for name, bus_config in source.get('buses', {}).items():
+        link = bus_config.get('transport', 'serial')
+        if link not in ('serial', 'rtu_tcp', 'modbus_tcp'):
+            logger.error(f"Transport '{link}' inconnu pour le bus {name}, bus ignoré")
+            continue
+        missing = [key for key in (('port',) if link == 'serial' else ('host', 'port')) if key not in bus_config]
+        if missing:
+            raise ValueError(f"Bus {name} : paramètre(s) {', '.join(missing)} manquant(s) pour le transport {link}")
+        buses[name] = {
+            'name': name,
+            'link': link,
+            'port': bus_config['port'],
+            'baudrate': bus_config.get('baudrate', 9600),
+            'timeout': bus_config.get('timeout', 3.0),
+            'driver': bus_config.get('driver', 'modbus_tk')
+        }
+        if link != 'serial':
+            # 'port' désigne alors le port TCP de la passerelle
+            buses[name].update({'host': bus_config['host'], 'tcp_port': bus_config['port'],
+                                'port': f"{bus_config['host']}:{bus_config['port']}"})
+
+    for bus in buses.values():
+        bus['sensors'] = []
+        # Commandes en attente d'un créneau libre entre deux lectures
+        bus['commands'] = collections.deque()
+        bus['wakeup'] = asyncio.Event()
+        bus['stats'] = {
+            'polls': 0,
+            'last_poll_s': None,
+            'avg_poll_s': None,
+            'max_poll_s': 0.0,
+            'missed_deadlines': 0,
+            'last_lag_s': None,
+            'avg_lag_s': 0.0,
+            'max_lag_s': 0.0,
+            'consecutive_errors': 0
+        }
+
+    for sensor in source['sensors']:
+        if not sensor.get('enabled', True):
+            continue
+        bus_name = sensor.get('bus', 'default')
+        if bus_name not in buses:
+            logger.error(f"Bus '{bus_name}' inconnu pour le capteur {sensor['name']}, capteur ignoré")
+            continue
+        buses[bus_name]['sensors'].append(sensor)
+        buses[bus_name].setdefault('breakers', {})[sensor['device_id']] = make_breaker()
+
+    return [bus for bus in buses.values() if bus['sensors'] or include_empty]
+
+def open_bus(bus):
+    """Ouvre le port série (ou la connexion de passerelle) d'un bus et prépare le transport associé"""
+    # Temporisation du bus dérivée du baudrate et des temps de réponse mesurés
+    bus['timing'] = BusTiming(bus['baudrate'], max_timeout=bus['timeout'])
+
+    if bus['link'] != 'serial':
+        # Connexion et thread partagés par les bus d'une même passerelle
+        gateway = acquire_gateway(bus)
+        bus['executor'] = gateway['executor']
+        if bus['link'] == 'modbus_tcp':
+            bus['transport'] = ModbusTcpTransport(gateway['stream'])
+        else:
+            # RTU encapsulé dans TCP (ser2net en mode raw) : trames RTU inchangées, transport intégré
+            bus['transport'] = PzemRtuTransport(gateway['stream'])
+        try:
+            gateway['stream'].open()
+        except OSError as e:
+            logger.warning(f"Passerelle du bus {bus['name']} ({bus['port']}) injoignable, nouvelle tentative à la première lecture: {e}")
+        return
+
+    serial_connection = serial.Serial(
+                        port=bus['port'],
+                        baudrate=bus['baudrate'],
+                        bytesize=8,
+                        parity='N',
+                        stopbits=1,
+                        xonxoff=0,
+                        timeout=bus['timeout'],
+                        write_timeout=2.0
+                        )
+
+    if bus['driver'] == 'builtin':
+        bus['transport'] = PzemRtuTransport(serial_connection)
+    else:
+        bus['transport'] = ModbusTkTransport(serial_connection, bus['timeout'])
+
+    # Les transactions série bloquantes s'exécutent dans un thread dédié au bus
+    bus['executor'] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"bus-{bus['name']}")
+
+async def close_bus(bus):
+    """Ferme le port série du bus, ou la connexion de sa passerelle quand plus aucun bus ne l'utilise"""
+    if bus['link'] != 'serial' and not release_gateway(bus):
+        return
+    # Fermeture dans le thread du bus, après l'éventuelle transaction en cours
+    await asyncio.get_running_loop().run_in_executor(bus['executor'], bus['transport'].close)
+    bus['executor'].shutdown(wait=False)
+
+def sensor_status_key(bus_name, device_id):
+    """Clé d'un capteur dans le monitoring (inchangée pour le bus par défaut)"""
+    if bus_name == 'default':
+        return f"sensor_{device_id}"
+    return f"{bus_name}_sensor_{device_id}"
+
+def record_read_failure(bus, id, error_type, probe=False):
+    """Comptabilise un échec de lecture pour un capteur"""
+    error_stats[error_type + 's'] += 1
+    metrics.inc('pzem_reads_total', (('bus', bus['name']), ('address', id), ('result', error_type)))
+    # Les sondes d'un capteur disjoncté ne déclenchent pas la réinitialisation du bus
+    if not probe:
+        error_stats['consecutive_errors'] += 1
+        bus['stats']['consecutive_errors'] += 1
+
+    # Enregistrement de l'échec pour ce capteur
+    error_stats['last_reads_by_sensor'][(bus['name'], id)] = {
+        'timestamp': datetime.now(),
+        'success': False,
+        'error_type': error_type
+    }
+
+async def getPzem004t(bus, id, max_retries=3, probe=False):
+    """
+    Lecture des données PZEM avec gestion des erreurs CRC et retry automatique.
+    En mode sonde (capteur disjoncté), une seule tentative avec un timeout court.
+    """
+    global error_stats
+
+    transport = bus['transport']
+    timing = bus['timing']
+    loop = asyncio.get_running_loop()
+
+    if probe:
+        max_retries = 1
+
+    for attempt in range(max_retries):
+        if attempt:
+            # Un capteur muet épuise ses tentatives : les commandes en retard passent entre deux
+            await run_overdue_commands(bus)
+        try:
+            error_stats['total_reads'] += 1
+            
+            # Respect du silence inter-trame et timeout adapté au capteur
+            await timing.wait_for_bus()
+
+            # Lecture des registres Modbus sans bloquer la boucle asyncio
+            start = time.monotonic()
+            try:
+                timeout = timing.timeout_for(id)
+                if probe:
+                    timeout = min(timeout, breaker_config.get('probe_timeout', 0.5))
+                data = await loop.run_in_executor(bus['executor'], transport.read_input_registers, id, timeout)
+            except Exception:
+                timing.record_failure(id)
+                raise
+            rtt = time.monotonic() - start
+            timing.record_success(id, rtt)
+            labels = (('bus', bus['name']), ('address', id))
+            metrics.observe('pzem_modbus_rtt_seconds', labels, rtt, MetricsRegistry.RTT_BUCKETS)
+            metrics.observe('pzem_read_attempts', labels, attempt + 1, MetricsRegistry.ATTEMPT_BUCKETS)
+            metrics.inc('pzem_reads_total', labels + (('result', 'ok'),))
+
+            # Calcul des valeurs (quotients exacts au dixième, centième ou millième près)
+            tension = data[0] / 10.0                                  # [V]
+            courant = (data[1] + (data[2] << 16)) / 1000.0            # [A]
+            puissance = (data[3] + (data[4] << 16)) / 10.0            # [W]
+            energy = (data[5] + (data[6] << 16)) / 1000.0             # [kWh]
+            frequency = data[7] / 10.0                                # [Hz]
+            facteurDePuiss = data[8] / 100.0                          # [%]
+            puissanceApparente = round(courant * tension, 2)          # [VA]
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Capteur {id} : index {data[5] + (data[6] << 16)} Wh, {tension} V, {courant} A, "
+                             f"{puissance} W, {energy} kWh, {frequency} Hz, facteur de puiss. {facteurDePuiss}, "
+                             f"{puissanceApparente} VA")
+
+            # Timestamp de la lecture
+            reading_time = time.time()
+            reading_timestamp = datetime.fromtimestamp(reading_time)
+
+            # Réussite - reset du compteur d'erreurs consécutives
+            error_stats['consecutive_errors'] = 0
+            bus['stats']['consecutive_errors'] = 0
+            error_stats['last_successful_read'] = reading_timestamp
+
+            # Stockage de la dernière lecture pour ce capteur
+            error_stats['last_reads_by_sensor'][(bus['name'], id)] = {
+                'timestamp': reading_timestamp,
+                'success': True
+            }
+            
+            logger.info("Reading PZEM004T ok. Sensor n° %s (attempt %s/%s)", id, attempt + 1, max_retries)
+
+            # Valeurs brutes : la mise en forme du message revient à payload_encoder
+            return {
+                "current": courant,
+                "energy": energy,
+                "power": puissance,
+                "voltage": tension,
+                "facteur_de_puiss": facteurDePuiss,
+                "frequency": frequency,
+                "apparent_power": puissanceApparente,
+                "time": reading_time
+            }
+
+        except ModbusInvalidResponseError as e:
+            record_read_failure(bus, id, 'crc_error', probe)
+
+            logger.warning(f"Erreur CRC capteur {id}, tentative {attempt + 1}/{max_retries}: {str(e)}")
+            
+            if attempt < max_retries - 1:
+                # Délai adapté au taux d'erreurs observé sur le bus
+                delay = timing.backoff(attempt)
+                logger.debug(f"Attente de {delay:.3f}s avant la prochaine tentative")
+                await asyncio.sleep(delay)
+            
+        except Exception as e:
+            # Exception 0x0A / 0x0B d'une passerelle Modbus TCP : le capteur n'a pas répondu
+            if "timeout" in str(e).lower() or (isinstance(e, ModbusError) and bus['link'] == 'modbus_tcp'
+                                               and e.get_exception_code() in ModbusTcpTransport.GATEWAY_EXCEPTIONS):
+                error_type = 'timeout_error'
+            else:
+                error_type = 'other_error'
+            record_read_failure(bus, id, error_type, probe)
+
+            logger.warning(f"Erreur lecture capteur {id}, tentative {attempt + 1}/{max_retries}: {str(e)}")
+            
+            if attempt < max_retries - 1:
+                await asyncio.sleep(timing.backoff(attempt))
+
+    # Toutes les tentatives ont échoué
+    logger.error(f"Échec lecture capteur {id} (bus {bus['name']}) après {max_retries} tentatives. Stats: CRC={error_stats['crc_errors']}, Timeout={error_stats['timeout_errors']}, Autres={error_stats['other_errors']}")
+    return None
+
+class SensorScheduler:
+    """
+    Planificateur par échéances des capteurs d'un bus.
+
+    Tas trié sur la prochaine échéance de chaque capteur : les échéances sont
+    absolues (échéance précédente + intervalle du capteur), la durée des lectures
+    ne provoque donc pas de dérive. Parmi les capteurs échus, le plus prioritaire
+    est servi en premier.
+    """
+
+    def __init__(self, sensors, now):
+        self._heap = []
+        self._seq = itertools.count()
+        self.sensors = {}  # Définition courante de chaque capteur planifié, clé device_id
+        self.stats = {}  # Statistiques d'ordonnancement par device_id
+        for sensor in sensors:
+            self.add(sensor, now)
+
+    @staticmethod
+    def interval(sensor):
+        """Intervalle de polling du capteur (global par défaut)"""
+        return sensor.get('poll_interval', poll_interval)
+
+    def add(self, sensor, due):
+        self.sensors[sensor['device_id']] = sensor
+        heapq.heappush(self._heap, (due, next(self._seq), sensor))
+        self.stats.setdefault(sensor['device_id'], {'polls': 0, 'missed_deadlines': 0, 'last_lag_s': None, 'max_lag_s': 0.0})
+
+    def remove(self, device_id):
+        """Retire un capteur du planning (rechargement de configuration)"""
+        self.sensors.pop(device_id, None)
+        self.stats.pop(device_id, None)
+        self._heap = [entry for entry in self._heap if entry[2]['device_id'] != device_id]
+        heapq.heapify(self._heap)
+
+    def update(self, sensor, now):
+        """Remplace la définition d'un capteur ; son échéance est conservée, bornée par le nouvel intervalle"""
+        self.sensors[sensor['device_id']] = sensor
+        for index, (due, seq, current) in enumerate(self._heap):
+            if current['device_id'] == sensor['device_id']:
+                self._heap[index] = (min(due, now + self.interval(sensor)), seq, sensor)
+                heapq.heapify(self._heap)
+                break
+
+    def next_due(self):
+        return self._heap[0][0]
+
+    def pop_ready(self, now):
+        """Retire le capteur échu le plus prioritaire, retourne (échéance, capteur)"""
+        ready = []
+        while self._heap and self._heap[0][0] <= now:
+            ready.append(heapq.heappop(self._heap))
+        best = max(ready, key=lambda entry: (entry[2].get('priority', 0), -entry[0], -entry[1]))
+        for entry in ready:
+            if entry is not best:
+                heapq.heappush(self._heap, entry)
+        return best[0], best[2]
+
+    def reschedule(self, sensor, due, started, now):
+        """Replanifie le capteur sur sa prochaine échéance et met à jour ses statistiques"""
+        # Définition rechargée pendant la lecture, ou capteur retiré du planning
+        sensor = self.sensors.get(sensor['device_id'])
+        if sensor is None:
+            return started - due, 0
+
+        interval = self.interval(sensor)
+        stats = self.stats[sensor['device_id']]
+        lag = started - due
+        stats['polls'] += 1
+        stats['last_lag_s'] = lag
+        stats['max_lag_s'] = max(stats['max_lag_s'], lag)
+
+        # Échéances dépassées pendant la lecture : on les saute en restant sur la grille
+        next_due = due + interval
+        missed = 0
+        if next_due <= now:
+            missed = int((now - next_due) // interval) + 1
+            next_due += missed * interval
+        stats['missed_deadlines'] += missed
+
+        self.add(sensor, next_due)
+        return lag, missed
+
+async def check_bus_health(bus):
+    """Réinitialise la connexion série du bus en cas de trop nombreuses erreurs consécutives"""
+    transport = bus['transport']
+    bus_stats = bus['stats']
+
+    if bus_stats['consecutive_errors'] >= 10:
+        logger.warning(f"Trop d'erreurs consécutives sur le bus {bus['name']} ({bus_stats['consecutive_errors']}), tentative de réinitialisation de la connexion série")
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(bus['executor'], transport.close)
+            await asyncio.sleep(2)
+            await loop.run_in_executor(bus['executor'], transport.open)
+            bus_stats['consecutive_errors'] = 0
+            logger.info(f"Connexion série du bus {bus['name']} réinitialisée avec succès")
+        except Exception as e:
+            logger.error(f"Échec de la réinitialisation de la connexion série du bus {bus['name']}: {e}")
+
+def outside_deadband(value, previous, band):
+    """Indique si la valeur est sortie de la bande morte (absolue 'abs' ou en pourcentage 'pct')"""
+    delta = abs(value - previous)
+    if 'abs' in band and delta > band['abs']:
+        return True
+    if 'pct' in band and delta > abs(previous) * band['pct'] / 100.0:
+        return True
+    return False
+
+def should_publish(sensor, payload, now):
+    """
+    Report-by-exception : publication uniquement si une valeur sort de sa bande morte
+    ou si la dernière publication est plus ancienne que max_age
+    """
+    deadbands = sensor.get('deadbands', publish_config.get('deadbands'))
+    if not deadbands:
+        return True
+
+    previous = last_published.get(sensor['unique_id'])
+    if previous is None:
+        return True
+
+    published_at, previous_payload = previous
+    max_age = sensor.get('max_age', publish_config.get('max_age', 300))
+    if now - published_at >= max_age:
+        return True
+
+    for field, band in deadbands.items():
+        if field in payload and outside_deadband(payload[field], previous_payload[field], band):
+            return True
+    return False
+
+class Spool:
+    """
+    Spool borné sur disque (SQLite en mode WAL) des messages produits quand le
+    broker est injoignable, rejoués à la reconnexion sur un topic de backfill.
+    """
+
+    def __init__(self, path, max_rows=100000):
+        self.max_rows = max_rows
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT NOT NULL, payload TEXT NOT NULL)")
+        self.db.commit()
+        self.depth = self.db.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+        self.stats = {'stored': 0, 'dropped': 0, 'replayed': 0, 'last_replay_rate': None}
+
+    def store(self, topic, payload):
+        """Enregistre un message, en supprimant les plus anciens au-delà de max_rows"""
+        self.db.execute("INSERT INTO spool (topic, payload) VALUES (?, ?)", (topic, payload))
+        self.depth += 1
+        self.stats['stored'] += 1
+        if self.depth > self.max_rows:
+            overflow = self.depth - self.max_rows
+            self.db.execute("DELETE FROM spool WHERE id IN (SELECT id FROM spool ORDER BY id LIMIT ?)", (overflow,))
+            self.depth -= overflow
+            self.stats['dropped'] += overflow
+        self.db.commit()
+
+    def fetch(self, limit):
+        """Plus anciens messages du spool : liste de (id, topic, payload)"""
+        return self.db.execute("SELECT id, topic, payload FROM spool ORDER BY id LIMIT ?", (limit,)).fetchall()
+
+    def delete(self, ids):
+        """Supprime les messages rejoués et acquittés par le broker"""
+        # rowcount : une partie a pu être évincée par store() pendant le rejeu
+        count = self.db.executemany("DELETE FROM spool WHERE id = ?", [(row_id,) for row_id in ids]).rowcount
+        self.db.commit()
+        self.depth = max(0, self.depth - count)
+        self.stats['replayed'] += count
+
+def backfill_topic(topic):
+    """Topic de rejeu correspondant à un topic de données"""
+    return f"{base_topic}/backfill/{topic[len(base_topic) + 1:]}"
+
+# Colonnes d'un enregistrement d'historique : (champ, type struct, facteur d'échelle).
+# Entiers à la résolution du PZEM : valeurs exactes sur une taille fixe.
+HISTORY_COLUMNS = [
+    ('voltage', 'H', 10),
+    ('current', 'I', 1000),
+    ('power', 'I', 10),
+    ('energy', 'I', 1000),
+    ('frequency', 'H', 10),
+    ('facteur_de_puiss', 'H', 100)
+]
+# Millisecondes depuis minuit UTC, puis les colonnes : 22 octets par lecture
+HISTORY_RECORD = struct.Struct('<I' + ''.join(code for _, code, _ in HISTORY_COLUMNS))
+HISTORY_HEADER = struct.Struct('<4sHH')  # Signature, taille d'enregistrement, pas de l'index
+HISTORY_MAGIC = b'PZH1'
+HISTORY_INDEX = struct.Struct('<I')
+HISTORY_INDEX_STRIDE = 256
+
+def history_segment_path(path, unique_id, day):
+    """Segment d'un capteur pour un jour UTC (jours depuis l'epoch)"""
+    name = time.strftime('%Y-%m-%d', time.gmtime(day * 86400))
+    return os.path.join(path, unique_id, name + '.pzh')
+
+def history_segment_count(path):
+    """Nombre d'enregistrements complets d'un segment, None si son en-tête n'est pas reconnu"""
+    with open(path, 'rb') as f:
+        header = f.read(HISTORY_HEADER.size)
+        size = os.fstat(f.fileno()).st_size
+    if len(header) < HISTORY_HEADER.size or HISTORY_HEADER.unpack(header) != (HISTORY_MAGIC, HISTORY_RECORD.size, HISTORY_INDEX_STRIDE):
+        return None
+    return (size - HISTORY_HEADER.size) // HISTORY_RECORD.size
+
+class HistoryRecorder:
+    """
+    Historique local en ajout seul. Chaque lecture décodée est ajoutée au segment
+    du jour (UTC) de son capteur, {path}/{unique_id}/AAAA-MM-JJ.pzh : un en-tête
+    puis des enregistrements de taille fixe triés par temps, lisibles par mmap.
+    Le fichier .idx voisin conserve l'horodatage d'un enregistrement sur
+    HISTORY_INDEX_STRIDE pour positionner une requête sans parcourir le segment.
+    """
+
+    def __init__(self, path, flush_interval=10, retention_days=None):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        self.segments = {}  # unique_id -> segment du jour ouvert en écriture
+        self.purged_day = None
+        self.stats = {'records': 0, 'errors': 0, 'segments_opened': 0, 'segments_purged': 0}
+        os.makedirs(path, exist_ok=True)
+
+    def _open(self, unique_id, day):
+        """Ouvre un segment en ajout, après réparation d'un arrêt brutal (enregistrement tronqué)"""
+        path = history_segment_path(self.path, unique_id, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        count = history_segment_count(path) if os.path.exists(path) else None
+        if count is None and os.path.exists(path) and os.path.getsize(path) > 0:
+            # Format inconnu : le segment est mis de côté plutôt qu'écrasé
+            os.replace(path, path + '.invalid')
+            logger.warning(f"Segment d'historique illisible mis de côté : {path}.invalid")
+
+        if count is None:
+            count = 0
+            data = open(path, 'wb')
+            data.write(HISTORY_HEADER.pack(HISTORY_MAGIC, HISTORY_RECORD.size, HISTORY_INDEX_STRIDE))
+        else:
+            data = open(path, 'r+b')
+            data.truncate(HISTORY_HEADER.size + count * HISTORY_RECORD.size)
+
+        # Index reconstruit à partir des données (une lecture par pas d'index)
+        times = []
+        for position in range(0, count, HISTORY_INDEX_STRIDE):
+            data.seek(HISTORY_HEADER.size + position * HISTORY_RECORD.size)
+            times.append(HISTORY_INDEX.unpack(data.read(HISTORY_INDEX.size))[0])
+        last_ms = 0
+        if count:
+            data.seek(HISTORY_HEADER.size + (count - 1) * HISTORY_RECORD.size)
+            last_ms = HISTORY_INDEX.unpack(data.read(HISTORY_INDEX.size))[0]
+        data.seek(0, os.SEEK_END)
+        index = open(path[:-4] + '.idx', 'wb')
+        index.write(b''.join(HISTORY_INDEX.pack(t) for t in times))
+
+        self.stats['segments_opened'] += 1
+        return {'day': day, 'data': data, 'index': index, 'count': count, 'last_ms': last_ms}
+
+    def append(self, sensor, reading):
+        """Ajoute une lecture (valeurs brutes de getPzem004t) au segment du jour de son capteur"""
+        unique_id = sensor['unique_id']
+        day = int(reading['time'] // 86400)
+        try:
+            segment = self.segments.get(unique_id)
+            if segment is None or segment['day'] != day:
+                if segment is not None:
+                    self._close(segment)
+                segment = self.segments[unique_id] = self._open(unique_id, day)
+                self.purge(day)
+
+            # Horloge reculée (NTP) : le segment reste trié
+            ms = max(int((reading['time'] - day * 86400) * 1000), segment['last_ms'])
+            record = HISTORY_RECORD.pack(ms, *(int(round(reading[field] * scale)) for field, _, scale in HISTORY_COLUMNS))
+            if segment['count'] % HISTORY_INDEX_STRIDE == 0:
+                segment['index'].write(HISTORY_INDEX.pack(ms))
+            segment['data'].write(record)
+            segment['count'] += 1
+            segment['last_ms'] = ms
+            self.stats['records'] += 1
+        except (OSError, struct.error) as e:
+            self.stats['errors'] += 1
+            logger.warning(f"Lecture de {sensor['name']} non enregistrée dans l'historique: {e}")
+
+    def flush(self):
+        """Écrit les tampons sur disque (données avant index : l'index n'est jamais en avance)"""
+        for segment in self.segments.values():
+            try:
+                segment['data'].flush()
+                segment['index'].flush()
+            except OSError as e:
+                self.stats['errors'] += 1
+                logger.warning(f"Écriture de l'historique impossible: {e}")
+
+    def _close(self, segment):
+        segment['data'].close()
+        segment['index'].close()
+
+    def close(self):
+        self.flush()
+        for segment in self.segments.values():
+            self._close(segment)
+        self.segments.clear()
+
+    def purge(self, day):
+        """Supprime, une fois par jour, les segments plus anciens que retention_days"""
+        if not self.retention_days or self.purged_day == day:
+            return
+        self.purged_day = day
+        oldest = os.path.basename(history_segment_path(self.path, '', day - self.retention_days))
+        for unique_id in os.listdir(self.path):
+            directory = os.path.join(self.path, unique_id)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.endswith(('.pzh', '.idx')) and name[:-4] + '.pzh' < oldest:
+                    os.remove(os.path.join(directory, name))
+                    self.stats['segments_purged'] += name.endswith('.pzh')
+
+def history_start_position(path, data, count, start_ms):
+    """Premier enregistrement d'un segment à start_ms ou après : index puis parcours d'au plus un pas"""
+    index = array('I')
+    try:
+        with open(path[:-4] + '.idx', 'rb') as f:
+            index.frombytes(f.read())
+    except OSError:
+        pass
+    # Entrées décrivant des enregistrements présents (le démon peut être en train d'écrire)
+    entries = min(len(index), (count + HISTORY_INDEX_STRIDE - 1) // HISTORY_INDEX_STRIDE)
+    block = max(0, bisect.bisect_left(index, start_ms, 0, entries) - 1)
+    position = block * HISTORY_INDEX_STRIDE
+    while position < count and HISTORY_INDEX.unpack_from(data, HISTORY_HEADER.size + position * HISTORY_RECORD.size)[0] < start_ms:
+        position += 1
+    return position
+
+def iter_history(path, unique_id, start, end):
+    """Lectures d'un capteur entre start (inclus) et end (exclu), epoch : (temps, valeurs) en flux, segment par segment"""
+    scales = [scale for _, _, scale in HISTORY_COLUMNS]
+    for day in range(int(start // 86400), int(end // 86400) + 1):
+        segment_path = history_segment_path(path, unique_id, day)
+        if not os.path.exists(segment_path):
+            continue
+        count = history_segment_count(segment_path)
+        if not count:
+            continue
+        base = day * 86400
+        start_ms = max(0, int((start - base) * 1000))
+        end_ms = (end - base) * 1000
+        with open(segment_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = HISTORY_HEADER.size + history_start_position(segment_path, data, count, start_ms) * HISTORY_RECORD.size
+            end_offset = HISTORY_HEADER.size + count * HISTORY_RECORD.size
+            while offset < end_offset:
+                record = HISTORY_RECORD.unpack_from(data, offset)
+                if record[0] >= end_ms:
+                    break
+                yield base + record[0] / 1000.0, [value / scale for value, scale in zip(record[1:], scales)]
+                offset += HISTORY_RECORD.size
+
+async def flush_history(recorder):
+    """Écriture périodique de l'historique : au plus flush_interval secondes de lectures perdues en cas de coupure"""
+    while True:
+        await asyncio.sleep(recorder.flush_interval)
+        recorder.flush()
+
+def history_path():
+    """Répertoire de l'historique local"""
+    return history_config.get('path', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history'))
+
+def parse_history_time(value):
+    """Instant de la ligne de commande : epoch, ou date ISO (heure locale si sans fuseau)"""
+    try:
+        return float(value)
+    except ValueError:
+        moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = local_zone.localize(moment)
+    return moment.timestamp()
+
+def downsample_history(rows, step):
+    """
+    Sous-échantillonnage en flux, une ligne par fenêtre de step secondes alignée
+    sur l'epoch : moyennes, puissance min/max et dernier index d'énergie.
+    """
+    power = [field for field, _, _ in HISTORY_COLUMNS].index('power')
+    energy = [field for field, _, _ in HISTORY_COLUMNS].index('energy')
+    window = None
+    for timestamp, values in rows:
+        key = timestamp // step
+        if key != window:
+            if window is not None:
+                yield window * step, samples, [total / samples for total in sums], power_min, power_max, last_energy
+            window, samples, sums = key, 0, [0.0] * (len(values) + 1)
+            power_min = power_max = values[power]
+        samples += 1
+        for position, value in enumerate(values):
+            sums[position] += value
+        sums[-1] += values[0] * values[1]  # Puissance apparente
+        power_min = min(power_min, values[power])
+        power_max = max(power_max, values[power])
+        last_energy = values[energy]
+    if window is not None:
+        yield window * step, samples, [total / samples for total in sums], power_min, power_max, last_energy
+
+def export_history(unique_id, start, end, step, output):
+    """Mode --export : lectures d'un capteur en CSV, brutes ou sous-échantillonnées, sans charger les segments en mémoire"""
+    path = history_path()
+    if not os.path.isdir(os.path.join(path, unique_id)):
+        available = sorted(os.listdir(path)) if os.path.isdir(path) else []
+        logger.error(f"Pas d'historique pour {unique_id} dans {path} (capteurs disponibles : {', '.join(available) or 'aucun'})")
+        return False
+
+    fields = [field for field, _, _ in HISTORY_COLUMNS]
+    writer = csv.writer(output)
+    rows = iter_history(path, unique_id, start, end)
+    if not step:
+        writer.writerow(['time', 'local_time'] + fields + ['apparent_power'])
+        for timestamp, values in rows:
+            local_time = datetime.fromtimestamp(timestamp, local_zone).isoformat(timespec='milliseconds')
+            writer.writerow([f"{timestamp:.3f}", local_time] + values + [round(values[0] * values[1], 2)])
+        return True
+
+    energy = fields.index('energy')
+    writer.writerow(['time', 'local_time', 'samples'] + fields + ['apparent_power', 'power_min', 'power_max'])
+    for timestamp, samples, means, power_min, power_max, last_energy in downsample_history(rows, step):
+        means = [round(mean, 3) for mean in means]
+        means[energy] = last_energy
+        local_time = datetime.fromtimestamp(timestamp, local_zone).isoformat(timespec='seconds')
+        writer.writerow([f"{timestamp:.0f}", local_time, samples] + means + [power_min, power_max])
+    return True
+
+class PublishQueue:
+    """
+    File de publication MQTT bornée, vidée par une tâche dédiée : la lecture du bus
+    ne fait que déposer les messages, la sérialisation JSON et l'envoi se font
+    hors du chemin Modbus. En cas de débordement, politique 'drop_oldest'
+    (suppression du plus ancien) ou 'coalesce' (une seule valeur en attente par
+    topic, la plus récente).
+    """
+
+    def __init__(self, max_size=1000, policy='coalesce', max_inflight=20):
+        self.max_size = max_size
+        self.policy = policy
+        self.max_inflight = max_inflight
+        self.items = collections.OrderedDict()
+        self.inflight = {}      # mid paho -> (instant de mise en file, rappel d'acquittement)
+        self.wakeup = asyncio.Event()
+        self._seq = itertools.count()
+        self.stats = {'enqueued': 0, 'published': 0, 'dropped': 0, 'coalesced': 0}
+
+    def put(self, topic, payload, qos=0, retain=True, spoolable=False, on_published=None):
+        """
+        Dépose un message (payload dict sérialisé par le worker, chaîne ou bytes).
+        on_published est appelé à l'acquittement du message, jamais s'il est perdu.
+        """
+        item = (topic, payload, qos, retain, spoolable, time.monotonic(), on_published)
+        key = topic if self.policy == 'coalesce' else next(self._seq)
+        self.stats['enqueued'] += 1
+        if key in self.items:
+            # Valeur plus récente pour un topic déjà en attente : elle remplace l'ancienne
+            self.items[key] = item
+            self.stats['coalesced'] += 1
+            metrics.inc('pzem_publish_queue_total', (('outcome', 'coalesced'),))
+        else:
+            if len(self.items) >= self.max_size:
+                self.items.popitem(last=False)
+                self.stats['dropped'] += 1
+                metrics.inc('pzem_publish_queue_total', (('outcome', 'dropped'),))
+            self.items[key] = item
+        self.wakeup.set()
+
+    def acknowledge(self, mid):
+        """Publication acquittée par le client (QoS 0 envoyé, QoS 1 PUBACK reçu)"""
+        entry = self.inflight.pop(mid, None)
+        if entry is not None:
+            enqueued, on_published = entry
+            metrics.observe('pzem_publish_latency_seconds', (), time.monotonic() - enqueued, MetricsRegistry.LATENCY_BUCKETS)
+            self.wakeup.set()
+            if on_published is not None:
+                on_published()
+
+    def reset_inflight(self):
+        """Connexion perdue : les acquittements en attente n'arriveront pas"""
+        self.inflight.clear()
+        self.wakeup.set()
+
+async def publish_worker(client, queue):
+    """Vide la file de publication en respectant max_inflight"""
+    while True:
+        while not queue.items or len(queue.inflight) >= queue.max_inflight:
+            queue.wakeup.clear()
+            await queue.wakeup.wait()
+
+        _, (topic, payload, qos, retain, spoolable, enqueued, on_published) = queue.items.popitem(last=False)
+        message = json.dumps(payload) if isinstance(payload, dict) else payload
+
+        # Broker perdu entre la mise en file et l'envoi : les données repartent au spool
+        # (sauf les messages binaires, qui ne se rejouent pas en tableaux JSON)
+        if spoolable and spool is not None and not client.is_connected():
+            if isinstance(message, str):
+                spool.store(topic, message)
+            continue
+
+        message_info = client.publish(topic, message, qos=qos, retain=retain)
+        if message_info.rc == mqtt.MQTT_ERR_SUCCESS:
+            queue.inflight[message_info.mid] = (enqueued, on_published)
+            queue.stats['published'] += 1
+            if spoolable and startup_stats['first_publish_s'] is None:
+                startup_stats['first_publish_s'] = round(time.monotonic() - startup_stats['started'], 3)
+                logger.info(f"Première mesure publiée {startup_stats['first_publish_s']}s après le démarrage")
+        else:
+            logger.debug(f"Publication sur {topic} refusée par le client MQTT (rc={message_info.rc})")
+
+# Créée avec les autres objets asyncio partagés par init_loop_state()
+publish_queue = None
+
+def init_loop_state():
+    """
+    Crée les objets asyncio partagés dans la boucle de asyncio.run() : jusqu'à Python 3.9,
+    un Event ou un Lock se lie dès sa création à la boucle courante, celle de l'import
+    n'étant pas celle qui exécute main().
+    """
+    global publish_queue, mqtt_connected, reload_lock
+    publish_queue = PublishQueue(publish_queue_size, publish_queue_policy, publish_max_inflight)
+    mqtt_connected = asyncio.Event()
+    reload_lock = asyncio.Lock()
+
+class PayloadEncoder:
+    """
+    Mise en forme des lectures pour MQTT, préparée une fois pour toutes : topics
+    par capteur, gabarits des messages et suffixe du fuseau horaire.
+
+    Formats (mqtt.payload_format) :
+    - json : message historique, valeurs et quatre horodatages texte
+    - json_min : valeurs et horodatage epoch "time", sans espaces
+    - msgpack, cbor : mêmes clés que json_min en binaire (modules msgpack / cbor2 optionnels)
+    - fields : un topic retenu par grandeur, {base_topic}/{unique_id}/{champ}, valeur seule
+    """
+
+    FORMATS = ('json', 'json_min', 'msgpack', 'cbor', 'fields')
+    FIELDS = ('current', 'energy', 'power', 'voltage', 'facteur_de_puiss', 'frequency', 'apparent_power')
+
+    # Les valeurs sont des float : %r produit la même représentation que json.dumps
+    JSON_TEMPLATE = ('{"current": %r, "energy": %r, "power": %r, "voltage": %r, "facteur_de_puiss": %r, '
+                     '"frequency": %r, "apparent_power": %r, "timestamp": "%s", "timestamp_local": "%s%s", '
+                     '"last_read": "%s", "last_read_local": "%s %s"}')
+    JSON_MIN_TEMPLATE = ('{"current":%r,"energy":%r,"power":%r,"voltage":%r,"facteur_de_puiss":%r,'
+                         '"frequency":%r,"apparent_power":%r,"time":%.3f}')
+
+    def __init__(self, format, zone):
+        if format not in self.FORMATS:
+            raise ValueError(f"format de payload inconnu : {format}")
+        self.format = format
+        self._pack = None
+        if format == 'msgpack':
+            import msgpack
+            self._pack = msgpack.packb
+        elif format == 'cbor':
+            import cbor2
+            self._pack = cbor2.dumps
+        self.binary = self._pack is not None
+        self._topics = {}  # unique_id -> (topic du capteur, topics par grandeur)
+        self.set_zone(zone)
+
+    def set_zone(self, zone):
+        """Fuseau du format json : replace(tzinfo=...) applique toujours le même décalage pytz, calculé ici une fois"""
+        sample = datetime(2000, 1, 1).replace(tzinfo=zone)
+        self._offset = sample.isoformat()[19:]
+        self._zone_name = sample.strftime('%Z')
+
+    def topics(self, sensor):
+        """Topic de données du capteur et topics par grandeur (mode fields)"""
+        topics = self._topics.get(sensor['unique_id'])
+        if topics is None:
+            topic = f"{base_topic}/{sensor['unique_id']}"
+            topics = self._topics[sensor['unique_id']] = (topic, tuple(f"{topic}/{field}" for field in self.FIELDS))
+        return topics
+
+    def _json(self, reading):
+        iso = datetime.fromtimestamp(reading['time']).isoformat()
+        last_read = iso[:19].replace('T', ' ')
+        return self.JSON_TEMPLATE % (
+            reading['current'], reading['energy'], reading['power'], reading['voltage'],
+            reading['facteur_de_puiss'], reading['frequency'], reading['apparent_power'],
+            iso, iso, self._offset, last_read, last_read, self._zone_name)
+
+    def _json_min(self, reading):
+        return self.JSON_MIN_TEMPLATE % (
+            reading['current'], reading['energy'], reading['power'], reading['voltage'],
+            reading['facteur_de_puiss'], reading['frequency'], reading['apparent_power'], reading['time'])
+
+    def encode(self, sensor, reading):
+        """Messages d'une lecture : liste de (topic, payload str ou bytes)"""
+        topic, field_topics = self.topics(sensor)
+        if self.format == 'json':
+            return [(topic, self._json(reading))]
+        if self.format == 'json_min':
+            return [(topic, self._json_min(reading))]
+        if self.format == 'fields':
+            return [(field_topic, repr(reading[field])) for field_topic, field in zip(field_topics, self.FIELDS)]
+        return [(topic, self._pack(reading))]
+
+    def spool_entry(self, sensor, reading):
+        """Lecture à conserver dans le spool : (topic du capteur, JSON) quel que soit le format"""
+        topic = self.topics(sensor)[0]
+        if self.format == 'json':
+            return topic, self._json(reading)
+        return topic, self._json_min(reading)
+
+def make_payload_encoder(format, zone):
+    """Encodeur du format configuré, JSON historique si le format est inconnu ou son module absent"""
+    try:
+        return PayloadEncoder(format, zone)
+    except (ValueError, ImportError) as e:
+        logger.error(f"Format de payload {format} indisponible ({e}), utilisation du format json")
+        return PayloadEncoder('json', zone)
+
+payload_encoder = make_payload_encoder(payload_format, local_zone)
+
+def publish_or_spool(client, topic, payload):
+    """Met en file un message de données, ou le conserve dans le spool si le broker est injoignable"""
+    if spool is not None and not client.is_connected():
+        spool.store(topic, json.dumps(payload))
+        logger.debug(f"Broker injoignable, message pour {topic} conservé dans le spool ({spool.depth} en attente)")
+        return False
+    publish_queue.put(topic, payload, qos=0, retain=True, spoolable=True)
+    return True
+
+def on_publish(client, userdata, mid, reason_code=None, properties=None):
+    """Publication prise en charge : mesure de la latence mise en file -> acquittement"""
+    publish_queue.acknowledge(mid)
+
+def on_disconnect(client, userdata, flags, reason_code, properties=None):
+    """Déconnexion du broker"""
+    logger.warning(f"Déconnecté du serveur MQTT : {reason_code}")
+    publish_queue.reset_inflight()
+
+# Attente maximale du PUBACK d'un message rejoué, puis pause avant de reprendre le rejeu [s]
+SPOOL_ACK_TIMEOUT = 10
+SPOOL_RETRY_DELAY = 5
+
+async def wait_for_puback(client, info, timeout):
+    """Attend sans bloquer la boucle l'acquittement d'une publication QoS 1 ; False si refusée, perdue ou expirée"""
+    deadline = time.monotonic() + timeout
+    while client.is_connected() and time.monotonic() < deadline:
+        try:
+            if info.is_published():
+                return True
+        except (ValueError, RuntimeError):
+            return False
+        await asyncio.sleep(0.01)
+    return False
+
+async def replay_spool(client):
+    """
+    Rejoue le spool dès que le broker est joignable : les messages sont regroupés
+    par topic d'origine en tableaux JSON publiés sur {base_topic}/backfill/...,
+    avec un débit limité pour ne pas saturer le broker. Un message n'est retiré du
+    spool qu'une fois son PUBACK reçu ; le premier échec interrompt le lot.
+    """
+    batch_size = spool_config.get('batch_size', 100)
+    max_rate = spool_config.get('replay_rate', 10)  # Messages MQTT par seconde
+
+    while True:
+        if not client.is_connected() or spool.depth == 0:
+            await asyncio.sleep(1)
+            continue
+
+        replay_start = time.monotonic()
+        replayed = 0
+        interrupted = False
+        logger.info(f"Rejeu du spool : {spool.depth} messages en attente")
+        while client.is_connected() and spool.depth > 0 and not interrupted:
+            rows = spool.fetch(batch_size)
+            if not rows:
+                break
+            grouped = {}
+            for row_id, topic, payload in rows:
+                ids, payloads = grouped.setdefault(topic, ([], []))
+                ids.append(row_id)
+                payloads.append(json.loads(payload))
+            published = []
+            for topic, (ids, payloads) in grouped.items():
+                info = client.publish(backfill_topic(topic), json.dumps(payloads), qos=1, retain=False)
+                if info.rc != mqtt.MQTT_ERR_SUCCESS or not await wait_for_puback(client, info, SPOOL_ACK_TIMEOUT):
+                    logger.warning(f"Rejeu du spool interrompu : publication sur {backfill_topic(topic)} non acquittée (rc={info.rc})")
+                    interrupted = True
+                    break
+                published.extend(ids)
+                await asyncio.sleep(1.0 / max_rate)
+            spool.delete(published)
+            replayed += len(published)
+
+        duration = time.monotonic() - replay_start
+        spool.stats['last_replay_rate'] = round(replayed / duration, 1) if duration > 0 else None
+        logger.info(f"Rejeu du spool terminé : {replayed} messages en {duration:.1f}s")
+        if interrupted:
+            await asyncio.sleep(SPOOL_RETRY_DELAY)
+
+class RingBuffer:
+    """
+    Tampon circulaire de taille fixe : un array de doubles pour les horodatages
+    et un par champ mesuré. La mémoire occupée ne dépend que de la capacité.
+    """
+
+    def __init__(self, capacity, fields):
+        self.capacity = capacity
+        self.fields = tuple(fields)
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.channels = {field: array('d', bytes(8 * capacity)) for field in self.fields}
+        self.head = 0   # Prochain emplacement d'écriture
+        self.count = 0
+
+    def append(self, timestamp, payload):
+        index = self.head
+        self.timestamps[index] = timestamp
+        for field, channel in self.channels.items():
+            channel[index] = payload[field]
+        self.head = (index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def indices(self):
+        """Indices des échantillons, du plus ancien au plus récent"""
+        start = (self.head - self.count) % self.capacity
+        return [(start + offset) % self.capacity for offset in range(self.count)]
+
+def aggregate_window(buffer, window_start, window_end):
+    """Min, max, moyenne, p95 de chaque champ et delta d'énergie sur la fenêtre [window_start, window_end["""
+    baseline = None
+    window = []
+    for index in buffer.indices():
+        timestamp = buffer.timestamps[index]
+        if timestamp < window_start:
+            baseline = index
+        elif timestamp < window_end:
+            window.append(index)
+    if not window:
+        return None
+
+    aggregate = {
+        "window_start": datetime.fromtimestamp(window_start).isoformat(),
+        "window_end": datetime.fromtimestamp(window_end).isoformat(),
+        "window_s": window_end - window_start,
+        "samples": len(window)
+    }
+    for field, channel in buffer.channels.items():
+        if field == 'energy':
+            continue
+        values = sorted(channel[index] for index in window)
+        aggregate[field] = {
+            "min": values[0],
+            "max": values[-1],
+            "mean": round(sum(values) / len(values), 3),
+            "p95": values[max(0, math.ceil(0.95 * len(values)) - 1)]
+        }
+
+    # Énergie consommée depuis le dernier échantillon de la fenêtre précédente
+    energy = buffer.channels['energy']
+    first = baseline if baseline is not None else window[0]
+    aggregate["energy_delta"] = round(energy[window[-1]] - energy[first], 3)
+    return aggregate
+
+def aggregate_reading(client, sensor, payload):
+    """Ajoute la lecture au tampon du capteur et publie l'agrégat à chaque fin de fenêtre"""
+    window = aggregation_config.get('window', 60)
+    fields = aggregation_config.get('fields', ['power', 'voltage', 'current'])
+    now = time.time()
+
+    aggregator = aggregators.get(sensor['unique_id'])
+    if aggregator is None:
+        aggregator = aggregators[sensor['unique_id']] = {
+            'buffer': RingBuffer(aggregation_config.get('capacity', 600), list(fields) + ['energy']),
+            # Fenêtres alignées sur l'horloge (par ex. chaque minute pleine)
+            'window_end': (math.floor(now / window) + 1) * window
+        }
+
+    # Fenêtre écoulée : publication de l'agrégat avant d'entamer la suivante
+    if now >= aggregator['window_end']:
+        window_end = aggregator['window_end']
+        aggregate = aggregate_window(aggregator['buffer'], window_end - window, window_end)
+        if aggregate is not None:
+            topic = f"{base_topic}/{sensor['unique_id']}/aggregate"
+            if publish_or_spool(client, topic, aggregate):
+                error_stats['aggregates_published'] += 1
+            logger.info(f"Agrégat publié pour {sensor['name']} sur {topic} ({aggregate['samples']} échantillons)")
+        aggregator['window_end'] = (math.floor(now / window) + 1) * window
+
+    aggregator['buffer'].append(now, payload)
+
+def publish_reading(client, sensor, reading):
+    """Publie une lecture brute, sauf si elle reste dans les bandes mortes"""
+    component_id = sensor['unique_id']
+    now = time.monotonic()
+    if should_publish(sensor, reading, now):
+        last_published[component_id] = (now, reading)
+        if spool is not None and not client.is_connected():
+            topic, message = payload_encoder.spool_entry(sensor, reading)
+            spool.store(topic, message)
+            logger.debug(f"Broker injoignable, message pour {topic} conservé dans le spool ({spool.depth} en attente)")
+            return
+        for topic, message in payload_encoder.encode(sensor, reading):
+            publish_queue.put(topic, message, qos=0, retain=True, spoolable=True)
+        error_stats['published_messages'] += 1
+        logger.info("Données publiées pour %s sur %s (%s)", sensor['name'], payload_encoder.topics(sensor)[0], payload_encoder.format)
+    else:
+        error_stats['suppressed_messages'] += 1
+        logger.debug("Données de %s dans les bandes mortes, publication ignorée", sensor['name'])
+
+async def process(client, bus, sensor):
+    """Lit un capteur du bus et publie ses données"""
+    global base_topic
+
+    bus_stats = bus['stats']
+    poll_start = time.monotonic()
+
+    # Capteur disjoncté : pas de lecture tant que le délai avant la prochaine sonde n'est pas écoulé
+    breaker = bus['breakers'][sensor['device_id']]
+    state = breaker.current_state(poll_start)
+    if state == CircuitBreaker.OPEN:
+        breaker.skipped_polls += 1
+        logger.debug(f"Capteur {sensor['name']} disjoncté, lecture ignorée")
+        return
+
+    logger.debug(f"Lecture du capteur {sensor['name']} (ID: {sensor['device_id']}, bus {bus['name']}, disjoncteur {state})")
+
+    # Lecture avec retry automatique
+    payload = await getPzem004t(bus, sensor['device_id'], probe=(state == CircuitBreaker.HALF_OPEN))
+
+    if payload:
+        if breaker.record_success():
+            logger.info(f"Capteur {sensor['name']} de nouveau joignable, disjoncteur refermé")
+    elif breaker.record_failure(time.monotonic()):
+        logger.warning(f"Capteur {sensor['name']} disjoncté pour {breaker.open_until - time.monotonic():.1f}s après {breaker.consecutive_failures} lectures en échec")
+
+    if payload:
+        if history is not None:
+            history.append(sensor, payload)
+        if aggregation_config.get('enabled', False):
+            aggregate_reading(client, sensor, payload)
+        # Avec l'agrégation, la publication de chaque lecture brute peut être désactivée
+        if aggregation_config.get('publish_raw', True):
+            publish_reading(client, sensor, payload)
+    else:
+        logger.warning(f"Échec de lecture du capteur {sensor['name']} (ID: {sensor['device_id']})")
+
+    # Statistiques de durée de lecture sur le bus
+    poll_duration = time.monotonic() - poll_start
+    metrics.observe('pzem_poll_duration_seconds', (('bus', bus['name']),), poll_duration, MetricsRegistry.DURATION_BUCKETS)
+    bus_stats['polls'] += 1
+    bus_stats['last_poll_s'] = poll_duration
+    bus_stats['max_poll_s'] = max(bus_stats['max_poll_s'], poll_duration)
+    if bus_stats['avg_poll_s'] is None:
+        bus_stats['avg_poll_s'] = poll_duration
+    else:
+        bus_stats['avg_poll_s'] += (poll_duration - bus_stats['avg_poll_s']) / bus_stats['polls']
+
+def maybe_publish_monitoring(client):
+    """Publie le monitoring périodiquement ou en cas de problème"""
+    # Publication des statistiques de monitoring toutes les 30 lectures ou en cas de problème
+    should_publish_monitoring = (
+        error_stats['total_reads'] % 30 == 0 or  # Toutes les 30 lectures
+        error_stats['consecutive_errors'] >= 5 or  # En cas de problèmes
+        error_stats['last_monitoring_publish'] is None or  # Premier envoi
+        (datetime.now() - error_stats['last_monitoring_publish']).total_seconds() > 300  # Toutes les 5 minutes minimum
+    )
+
+    if should_publish_monitoring and error_stats['total_reads'] > 0:
+        publish_monitoring_stats(client)
+
+    # Log des statistiques d'erreurs périodiquement (moins fréquent maintenant)
+    if error_stats['total_reads'] % 100 == 0 and error_stats['total_reads'] > 0:
+        success_rate = round((error_stats['total_reads'] - error_stats['crc_errors'] - error_stats['timeout_errors'] - error_stats['other_errors']) / error_stats['total_reads'] * 100, 2)
+        logger.info(f"Statistiques locales: {error_stats['total_reads']} lectures totales, {success_rate}% de succès, CRC errors: {error_stats['crc_errors']}, Timeouts: {error_stats['timeout_errors']}")
+
+async def bus_worker(client, bus):
+    """Boucle de polling dédiée à un bus série (une tâche asyncio par port)"""
+    logger.info(f"Démarrage du polling du bus {bus['name']} ({bus['port']}, {len(bus['sensors'])} capteurs)")
+    loop = asyncio.get_running_loop()
+    scheduler = bus['scheduler']
+    bus_stats = bus['stats']
+
+    commands = bus['commands']
+    wakeup = bus['wakeup']
+
+    while True:
+        # Commande en attente : exécutée si elle tient avant la prochaine échéance, ou si elle attend depuis trop longtemps
+        delay = scheduler.next_due() - loop.time()
+        if commands and (delay >= command_timeout(bus, commands[0]) or loop.time() - commands[0]['queued'] > COMMAND_MAX_WAIT):
+            command = commands.popleft()
+            if command['action'] == 'scan':
+                await execute_scan(bus, command)
+            else:
+                await execute_command(bus, command)
+            continue
+
+        # Attente de la prochaine échéance, interrompue par l'arrivée d'une commande
+        if delay > 0:
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        due, sensor = scheduler.pop_ready(loop.time())
+        started = loop.time()
+        try:
+            await check_bus_health(bus)
+            await process(client, bus, sensor)
+        except Exception as e:
+            logger.error(f"Erreur inattendue sur le bus {bus['name']}: {e}")
+
+        # Replanification sur l'échéance suivante, sans dérive
+        lag, missed = scheduler.reschedule(sensor, due, started, loop.time())
+        bus_stats['last_lag_s'] = lag
+        bus_stats['max_lag_s'] = max(bus_stats['max_lag_s'], lag)
+        bus_stats['avg_lag_s'] += (lag - bus_stats['avg_lag_s']) / bus_stats['polls'] if bus_stats['polls'] else 0.0
+        if missed:
+            bus_stats['missed_deadlines'] += missed
+            logger.debug(f"Capteur {sensor['name']} : {missed} échéance(s) manquée(s) (retard {lag:.3f}s)")
+
+        maybe_publish_monitoring(client)
+
+# ==================================================================
+# Commandes capteur (remise à zéro, écriture de registres)
+# ==================================================================
+
+# Délai maximal d'attente d'un créneau libre avant d'intercaler la commande entre deux lectures [s]
+COMMAND_MAX_WAIT = 5.0
+
+# Commandes acceptées sur {command_topic}/{unique_id}/{action} : (registre, valeur min, valeur max)
+SENSOR_COMMANDS = {
+    'reset_energy': None,
+    'set_alarm_threshold': (0x0001, 0, 23000),   # Seuil d'alarme de puissance [W]
+    'set_address': (0x0002, 1, 247)              # Adresse esclave Modbus
+}
+
+def command_timeout(bus, command):
+    """Timeout d'une commande : au moins 0.5 s, l'écriture en EEPROM du PZEM étant plus lente qu'une lecture"""
+    if command['action'] == 'scan':
+        # Le scan suspend de toute façon le polling : inutile d'attendre un créneau
+        return 0.0
+    timing = bus['timing']
+    return min(timing.max_timeout, max(timing.timeout_for(command['sensor']['device_id']), 0.5))
+
+async def run_overdue_commands(bus):
+    """Exécute entre deux tentatives de lecture les commandes capteur en attente depuis plus de COMMAND_MAX_WAIT"""
+    commands = bus['commands']
+    loop = asyncio.get_running_loop()
+    # Un scan suspend le polling : il attend la fin de la lecture en cours
+    while commands and commands[0]['action'] != 'scan' and loop.time() - commands[0]['queued'] > COMMAND_MAX_WAIT:
+        await execute_command(bus, commands.popleft())
+
+async def execute_command(bus, command):
+    """Exécute une commande sur le bus, entre deux lectures, et publie son résultat"""
+    sensor = command['sensor']
+    action = command['action']
+    timing = bus['timing']
+    loop = asyncio.get_running_loop()
+
+    if action == 'reset_energy':
+        pdu = struct.pack('>B', 0x42)
+    else:
+        pdu = struct.pack('>BHH', cst.WRITE_SINGLE_REGISTER, SENSOR_COMMANDS[action][0], command['value'])
+
+    await timing.wait_for_bus()
+    try:
+        await loop.run_in_executor(bus['executor'], bus['transport'].write_command,
+                                   sensor['device_id'], pdu, command_timeout(bus, command))
+        error = None
+    except (ModbusError, ModbusInvalidResponseError, PzemTimeoutError, OSError) as e:
+        error = str(e)
+    finally:
+        timing.release()
+
+    metrics.inc('pzem_commands_total', (('action', action), ('result', 'ok' if error is None else 'error')))
+    if error is None:
+        logger.info(f"Commande {action} exécutée sur {sensor['name']} (ID: {sensor['device_id']}, bus {bus['name']})")
+        if action == 'reset_energy':
+            # Compteur remis à zéro : la prochaine lecture est publiée et les fenêtres repartent de zéro
+            last_published.pop(sensor['unique_id'], None)
+            aggregators.pop(sensor['unique_id'], None)
+        elif action == 'set_address':
+            logger.warning(f"Capteur {sensor['name']} désormais à l'adresse {command['value']} : mettez à jour device_id dans config.json puis rechargez la configuration")
+    else:
+        logger.error(f"Échec de la commande {action} sur {sensor['name']} (ID: {sensor['device_id']}): {error}")
+
+    publish_command_result(sensor, action, command['value'], error)
+
+def publish_command_result(sensor, action, value, error):
+    """Publie le résultat d'une commande sur {command_topic}/{unique_id}/{action}/result"""
+    result = {
+        "action": action,
+        "value": value,
+        "success": error is None,
+        "error": error,
+        "timestamp": datetime.now().isoformat()
+    }
+    publish_queue.put(f"{command_topic}/{sensor['unique_id']}/{action}/result", result, qos=1, retain=False)
+
+def on_sensor_command(client, userdata, message):
+    """Commande MQTT {command_topic}/{unique_id}/{action} : mise en file sur le bus du capteur"""
+    # Une commande retenue serait rejouée à chaque reconnexion
+    if message.retain:
+        return
+
+    unique_id, action = message.topic[len(command_topic) + 1:].split('/')
+    if action not in SENSOR_COMMANDS:
+        logger.warning(f"Commande inconnue sur {message.topic}")
+        return
+
+    for bus in buses:
+        sensor = next((sensor for sensor in bus['sensors'] if sensor['unique_id'] == unique_id), None)
+        if sensor is not None:
+            break
+    else:
+        if cluster is not None and unique_id in enabled_sensors(config['sensors']):
+            logger.debug(f"Commande {action} pour {unique_id} laissée au nœud qui interroge son bus")
+            return
+        logger.warning(f"Commande {action} ignorée : capteur {unique_id} inconnu ou inactif")
+        return
+
+    value = None
+    if SENSOR_COMMANDS[action] is not None:
+        _, minimum, maximum = SENSOR_COMMANDS[action]
+        try:
+            value = int(message.payload.decode().strip())
+        except (UnicodeDecodeError, ValueError):
+            value = None
+        if value is None or not minimum <= value <= maximum:
+            logger.warning(f"Commande {action} ignorée pour {unique_id} : valeur attendue entre {minimum} et {maximum}")
+            return
+
+    if action == 'set_address':
+        # Deux capteurs à la même adresse rendraient le bus illisible pour l'un comme pour l'autre
+        conflict = next((other for other in config['sensors']
+                         if other.get('bus', 'default') == bus['name'] and other['unique_id'] != unique_id
+                         and other['device_id'] == value), None)
+        if conflict is not None:
+            error = f"adresse {value} déjà attribuée au capteur {conflict['name']} sur le bus {bus['name']}"
+            logger.error(f"Commande {action} refusée pour {sensor['name']} : {error}")
+            metrics.inc('pzem_commands_total', (('action', action), ('result', 'rejected')))
+            publish_command_result(sensor, action, value, error)
+            return
+
+    bus['commands'].append({'sensor': sensor, 'action': action, 'value': value, 'queued': asyncio.get_running_loop().time()})
+    bus['wakeup'].set()
+    logger.info(f"Commande {action} mise en file pour {sensor['name']} (bus {bus['name']})")
+
+# ==================================================================
+# Scan des adresses d'un bus
+# ==================================================================
+
+# Retournement supposé tant qu'aucun capteur du bus n'a répondu [s]
+SCAN_DEFAULT_TURNAROUND = 0.03
+
+scan_task = None
+
+def scan_cache_path():
+    """Fichier du dernier résultat de scan par bus"""
+    return scan_config.get('cache', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scan_cache.json'))
+
+async def scan_bus(bus, first=1, last=247):
+    """
+    Sonde les adresses first..last d'un bus ouvert avec un timeout court, calibré sur
+    le temps de retournement déjà mesuré sur le bus puis sur celui des capteurs trouvés.
+    """
+    timing = bus['timing']
+    loop = asyncio.get_running_loop()
+    transport = bus['transport']
+    if isinstance(transport, ModbusTkTransport):
+        # modbus_tk ne distingue pas un silence d'une trame corrompue : sondes via le transport intégré
+        transport = PzemRtuTransport(transport.serial)
+
+    measured = list(timing.turnaround.values())
+    started = time.monotonic()
+    devices = {}
+    for address in range(first, last + 1):
+        turnaround = max(measured) if measured else SCAN_DEFAULT_TURNAROUND
+        timeout = min(timing.max_timeout, timing.wire_time + 3 * turnaround + timing.t35)
+        # Une trame partielle ou corrompue signale un esclave : une seconde sonde avec un timeout doublé
+        for attempt in range(2):
+            await timing.wait_for_bus()
+            start = time.monotonic()
+            try:
+                registers = await loop.run_in_executor(bus['executor'], transport.read_input_registers, address, timeout * (attempt + 1))
+            except PzemTimeoutError as e:
+                if e.received == 0:
+                    break
+                continue
+            except ModbusInvalidResponseError:
+                continue
+            except ModbusError as e:
+                # Réponse de la passerelle Modbus TCP à la place d'un esclave muet : adresse libre
+                if isinstance(transport, ModbusTcpTransport) and e.get_exception_code() in ModbusTcpTransport.GATEWAY_EXCEPTIONS:
+                    break
+                devices[address] = {"registers": None, "exception": e.get_exception_code()}
+                break
+            finally:
+                timing.release()
+
+            rtt = time.monotonic() - start
+            measured.append(max(0.0, rtt - timing.wire_time))
+            devices[address] = {"registers": list(registers), "rtt_ms": round(rtt * 1000, 1)}
+            break
+
+    addresses = sorted(devices)
+    return {
+        "port": bus['port'],
+        "baudrate": bus['baudrate'],
+        "first": first,
+        "last": last,
+        "addresses": addresses,
+        "devices": devices,
+        # Empreinte du bus : port et adresses présentes
+        "fingerprint": hashlib.sha256(json.dumps([bus['port'], addresses]).encode()).hexdigest()[:16],
+        "duration_s": round(time.monotonic() - started, 2),
+        "timeout_ms": round(timeout * 1000, 1),
+        "timestamp": datetime.now().isoformat()
+    }
+
+def record_scan(results):
+    """Compare le scan au précédent résultat en cache, puis met à jour le cache"""
+    path = scan_cache_path()
+    try:
+        with open(path, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    for bus_name, result in results.items():
+        previous = cache.get(bus_name)
+        if previous is None:
+            logger.info(f"Bus {bus_name} : {len(result['addresses'])} capteur(s) trouvé(s) {result['addresses']} en {result['duration_s']}s")
+        elif previous['fingerprint'] == result['fingerprint']:
+            logger.info(f"Bus {bus_name} : inchangé depuis le scan du {previous['timestamp']} {result['addresses']}")
+        else:
+            added = sorted(set(result['addresses']) - set(previous['addresses']))
+            missing = sorted(set(previous['addresses']) - set(result['addresses']))
+            logger.info(f"Bus {bus_name} : nouvelles adresses {added}, adresses disparues {missing}")
+        cache[bus_name] = result
+
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(cache, f, indent=1)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        logger.warning(f"Impossible d'enregistrer le cache de scan: {e}")
+
+def generate_sensors(results):
+    """Ajoute à config.json une entrée pour chaque adresse trouvée et non configurée"""
+    path = config_path()
+    with open(path, 'r') as f:
+        file_config = json.load(f)
+
+    configured = {(sensor.get('bus', 'default'), sensor['device_id']) for sensor in file_config['sensors']}
+    added = []
+    for bus_name, result in results.items():
+        for address in result['addresses']:
+            if (bus_name, address) in configured or result['devices'][address]['registers'] is None:
+                continue
+            sensor = {
+                "device_id": address,
+                "unique_id": f"pzem_{bus_name}_{address}",
+                "name": f"PZEM {bus_name} {address}",
+                "enabled": True
+            }
+            if bus_name != 'default':
+                sensor["bus"] = bus_name
+            added.append(sensor)
+
+    if added:
+        file_config['sensors'].extend(added)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(file_config, f, indent=2, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+        logger.info(f"{len(added)} capteur(s) ajouté(s) à {path} : {[sensor['unique_id'] for sensor in added]}")
+    return added
+
+async def execute_scan(bus, command):
+    """Exécute le scan d'un bus depuis sa tâche de polling (commande MQTT)"""
+    logger.info(f"Scan du bus {bus['name']} (adresses {command['first']} à {command['last']}), polling suspendu")
+    try:
+        command['future'].set_result(await scan_bus(bus, command['first'], command['last']))
+    except Exception as e:
+        command['future'].set_exception(e)
+
+async def scan_idle_buses(targets, first, last):
+    """Ouvre des bus sans tâche de polling, les sonde en parallèle puis les referme ; résultats par nom de bus"""
+    loop = asyncio.get_running_loop()
+    opened = []
+    for bus, result in zip(targets, await asyncio.gather(*[loop.run_in_executor(None, open_bus, bus) for bus in targets],
+                                                         return_exceptions=True)):
+        if isinstance(result, Exception):
+            logger.error(f"Impossible d'ouvrir le bus {bus['name']} ({bus['port']}): {result}")
+        else:
+            opened.append(bus)
+
+    scans = await asyncio.gather(*[scan_bus(bus, first, last) for bus in opened], return_exceptions=True)
+    results = {}
+    for bus, result in zip(opened, scans):
+        await close_bus(bus)
+        if isinstance(result, Exception):
+            logger.error(f"Scan du bus {bus['name']} interrompu: {result}")
+        else:
+            results[bus['name']] = result
+    return results
+
+async def run_scan(client, first, last, generate):
+    """
+    Scan en parallèle de tous les bus actifs, résultat retenu sur {base_topic}/scan (par nœud en mode cluster).
+    Les bus configurés sans capteur (nouvel adaptateur) sont ouverts le temps du scan.
+    """
+    loop = asyncio.get_running_loop()
+    futures = {}
+    for bus in buses:
+        futures[bus['name']] = loop.create_future()
+        bus['commands'].append({'action': 'scan', 'first': first, 'last': last, 'future': futures[bus['name']], 'queued': loop.time()})
+        bus['wakeup'].set()
+
+    # En mode cluster, un bus sans capteur n'est attribué à aucun nœud : il n'est sondé que par --scan
+    idle = []
+    if cluster is None:
+        running = {bus['name'] for bus in buses}
+        try:
+            idle = [bus for bus in build_buses(include_empty=True) if not bus['sensors'] and bus['name'] not in running]
+        except ValueError as e:
+            logger.error(f"Configuration des bus invalide, bus sans capteur non sondés: {e}")
+
+    outcomes, results = await asyncio.gather(asyncio.gather(*futures.values(), return_exceptions=True),
+                                             scan_idle_buses(idle, first, last))
+    for bus_name, outcome in zip(futures, outcomes):
+        if isinstance(outcome, BaseException):
+            logger.error(f"Scan du bus {bus_name} interrompu: {outcome!r}")
+        else:
+            results[bus_name] = outcome
+    record_scan(results)
+
+    added = []
+    if generate:
+        try:
+            added = generate_sensors(results)
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Impossible d'ajouter les capteurs trouvés à la configuration: {e}")
+        if added:
+            await reload_config(client)
 
-# Configuration du logging avec le niveau depuis la configuration
-log_level = getattr(logging, config['general'].get('log_level', 'INFO').upper())
-logging.basicConfig(level=log_level, format='   %(asctime)s %(levelname)-8s %(message)s')
-logger = logging.getLogger()
+    summary = {bus_name: {key: result[key] for key in ('port', 'addresses', 'fingerprint', 'duration_s', 'timeout_ms')}
+               for bus_name, result in results.items()}
+    publish_queue.put(f"{node_topic}/scan",
+                      {"buses": summary, "added_sensors": [sensor['unique_id'] for sensor in added],
+                       "timestamp": datetime.now().isoformat()}, qos=1, retain=True)
 
-# Variables globales depuis la configuration
-mqtt_host = config['mqtt']['host']
-mqtt_port = config['mqtt']['port']
-auto_discovery = config['mqtt']['auto_discovery']
-discovery_topic = config['mqtt']['discovery_topic']
-serial_port = config['serial']['port']
-base_topic = config['mqtt']['base_topic']
-local_tz = config['general']['local_tz']
-poll_interval = config['general']['poll_interval']
-lwt_topic = base_topic + "/lwt"
-monitoring_topic = base_topic + "/monitoring"
+def on_scan_command(client, userdata, message):
+    """Commande MQTT de scan : payload vide ou JSON {"first": 1, "last": 247, "generate": false}"""
+    global scan_task
 
-# Statistiques d'erreurs pour le monitoring
-error_stats = {
-    'total_reads': 0,
-    'crc_errors': 0,
-    'timeout_errors': 0,
-    'other_errors': 0,
-    'consecutive_errors': 0,
-    'last_successful_read': None,
-    'last_monitoring_publish': None,
-    'session_start': datetime.now(),
-    'last_reads_by_sensor': {}  # Stockage des dernières lectures par capteur
-}
-# ==================================================================
+    if message.retain:
+        return
+    if scan_task is not None and not scan_task.done():
+        logger.warning("Scan déjà en cours, commande ignorée")
+        return
+
+    try:
+        options = json.loads(message.payload) if message.payload.strip() else {}
+        first = int(options.get('first', scan_config.get('first', 1)))
+        last = int(options.get('last', scan_config.get('last', 247)))
+        generate = bool(options.get('generate', False))
+    except (ValueError, TypeError, AttributeError) as e:
+        logger.warning(f"Commande de scan ignorée, payload invalide: {e}")
+        return
+    if not 1 <= first <= last <= 247:
+        logger.warning(f"Commande de scan ignorée : plage d'adresses {first}-{last} invalide")
+        return
 
+    scan_task = asyncio.get_running_loop().create_task(run_scan(client, first, last, generate))
 
-def on_connect(client, userdata, flags, reason_code, properties=None):
-    """ Connection MQTT handler"""
+async def scan_cli(first, last, generate):
+    """Mode --scan : sonde en parallèle tous les bus configurés, service arrêté"""
+    try:
+        targets = build_buses(include_empty=True)
+    except ValueError as e:
+        logger.error(f"Configuration des bus invalide: {e}")
+        return
+    results = await scan_idle_buses(targets, first, last)
+    record_scan(results)
+    print(json.dumps(results, indent=2))
+    if generate:
+        generate_sensors(results)
 
-    global lwt_topic
-    logger.info("Connected to MQTT server with result code " + str(reason_code))
+def bus_gauge(value):
+    """Collecte d'une jauge par bus : value(bus) pour chaque bus, None si la valeur n'est pas disponible"""
+    def collect():
+        values = []
+        for bus in buses:
+            current = value(bus)
+            if current is not None:
+                values.append(((('bus', bus['name']),), current))
+        return values
+    return collect
 
-    client.publish(lwt_topic, "online", qos=1, retain=True)
+def collect_breaker_gauges():
+    """Jauge par capteur : 0 fermé, 1 semi-ouvert, 2 ouvert"""
+    levels = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+    now = time.monotonic()
+    return [((('bus', bus['name']), ('address', address)), levels[breaker.current_state(now)])
+            for bus in buses for address, breaker in bus.get('breakers', {}).items()]
 
-def getPzem004t(rtu, id, max_retries=3):
+metrics.gauge('pzem_bus_error_rate', bus_gauge(lambda bus: bus['timing'].error_rate if 'timing' in bus else None),
+              "Taux d'erreurs récent des transactions sur le bus")
+metrics.gauge('pzem_bus_consecutive_errors', bus_gauge(lambda bus: bus['stats']['consecutive_errors']),
+              "Erreurs de lecture consécutives sur le bus")
+metrics.gauge('pzem_bus_max_lag_seconds', bus_gauge(lambda bus: bus['stats']['max_lag_s']),
+              "Retard maximal d'une lecture sur son échéance")
+metrics.gauge('pzem_breaker_state', collect_breaker_gauges, "État du disjoncteur par capteur (0 fermé, 1 semi-ouvert, 2 ouvert)")
+metrics.gauge('pzem_publish_queue_depth', lambda: [((), len(publish_queue.items))],
+              "Messages en attente dans la file de publication")
+metrics.gauge('pzem_publish_queue_inflight', lambda: [((), len(publish_queue.inflight))],
+              "Publications MQTT envoyées en attente d'acquittement")
+metrics.gauge('pzem_spool_depth', lambda: [((), spool.depth)] if spool is not None else [], "Messages en attente dans le spool")
+metrics.gauge('pzem_startup_seconds',
+              lambda: [((('phase', phase[:-2]),), value) for phase, value in startup_stats.items()
+                       if phase != 'started' and value is not None],
+              "Durée des étapes du démarrage (bus prêts, connexion MQTT, première mesure publiée)")
+
+async def handle_metrics_request(reader, writer):
+    """Serveur HTTP minimal : GET /metrics"""
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode(errors='replace').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            body = metrics.render().encode()
+            status = '200 OK'
+        else:
+            body = b'Not Found\n'
+            status = '404 Not Found'
+        writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+class AsyncioMqttBridge:
     """
-    Lecture des données PZEM avec gestion des erreurs CRC et retry automatique
+    Intègre la boucle réseau du client paho dans la boucle asyncio :
+    lectures/écritures pilotées par add_reader/add_writer sur le socket MQTT,
+    maintenance (keepalive) et reconnexion dans une tâche dédiée.
     """
-    global error_stats
-    
-    for attempt in range(max_retries):
-        try:
-            error_stats['total_reads'] += 1
-            
-            # Petit délai avant chaque tentative pour stabiliser la communication
-            time.sleep(0.1)
-            
-            # Lecture des registres Modbus
-            data = rtu.execute(id, cst.READ_INPUT_REGISTERS, 0, 10)
-
-            # Calcul des valeurs
-            tension = round(data[0] / 10.0, 1)                        # [V]
-            courant = round((data[1] + (data[2] << 16)) / 1000.0, 3)  # [A]
-            courant_ma = round(data[1] + (data[2] << 16), 0)          # [mA]
-            puissance = round((data[3] + (data[4] << 16)) / 10.0, 1)  # [W]
-            energy = (data[5] + (data[6] << 16)) / 1000.0             # [kWh]
-            index = (data[5] + (data[6] << 16))                       # [Wh]
-            frequency = data[7] / 10.0                                # [Hz]
-            facteurDePuiss = data[8] / 100.0                          # [%]
-            puissanceApparente = round(courant * tension, 2)          # [VA]
 
-            logger.debug("Index [Wh] : {0}".format(index))
-            logger.debug("Tension [V] : {0}".format(tension))
-            logger.debug("Courant [A] : {0}".format(courant))
-            logger.debug("Courant [mA] : {0}".format(courant_ma))
-            logger.debug("Puissance [W] : {0}".format(puissance))
-            logger.debug("Energy [kWh] : {0}".format(energy))
-            logger.debug("Frequency [Hz] : {0}".format(frequency))
-            logger.debug("Facteur de Puiss. [%] : {0}".format(facteurDePuiss))
-            logger.debug("Puissance Apparente [VA] : {0}".format(puissanceApparente))
+    def __init__(self, client, loop):
+        self.client = client
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.misc_task = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
 
-            # Réussite - reset du compteur d'erreurs consécutives
-            error_stats['consecutive_errors'] = 0
-            error_stats['last_successful_read'] = datetime.now()
-            
-            # Timestamp de la lecture
-            reading_timestamp = datetime.now()
-            reading_timestamp_local = reading_timestamp.replace(tzinfo=timezone(local_tz))
-            
-            # Stockage de la dernière lecture pour ce capteur
-            error_stats['last_reads_by_sensor'][id] = {
-                'timestamp': reading_timestamp,
-                'timestamp_local': reading_timestamp_local,
-                'success': True
-            }
-            
-            logger.info("Reading PZEM004T ok. Sensor n° {0} (attempt {1}/{2})".format(id, attempt + 1, max_retries))
-            
-            jsondata = {
-                "current": float(courant),
-                "energy": float(energy),
-                "power": round(float(puissance), 1),
-                "voltage": float(tension),
-                "facteur_de_puiss": float(facteurDePuiss),
-                "frequency": float(frequency),
-                "apparent_power": float(puissanceApparente),
-                "timestamp": reading_timestamp.isoformat(),
-                "timestamp_local": reading_timestamp_local.isoformat(),
-                "last_read": reading_timestamp.strftime("%Y-%m-%d %H:%M:%S"),
-                "last_read_local": reading_timestamp_local.strftime("%Y-%m-%d %H:%M:%S %Z")
-            }
-            return jsondata
+    def start(self, host, port, keepalive):
+        """
+        Lance la connexion sans bloquer la boucle : paho ne fait que mémoriser les paramètres
+        et la tâche de maintenance tente aussitôt la connexion dans un thread, puis les
+        reconnexions si le broker est absent au lancement ou si la session tombe.
+        """
+        self.client.connect_async(host, port, keepalive=keepalive)
+        self.misc_task = self.loop.create_task(self.misc_loop())
 
-        except ModbusInvalidResponseError as e:
-            error_stats['crc_errors'] += 1
-            error_stats['consecutive_errors'] += 1
-            
-            # Enregistrement de l'échec pour ce capteur
-            error_stats['last_reads_by_sensor'][id] = {
-                'timestamp': datetime.now(),
-                'timestamp_local': datetime.now().replace(tzinfo=timezone(local_tz)),
-                'success': False,
-                'error_type': 'crc_error'
-            }
-            
-            logger.warning(f"Erreur CRC capteur {id}, tentative {attempt + 1}/{max_retries}: {str(e)}")
-            
-            if attempt < max_retries - 1:
-                # Délai progressif entre les tentatives
-                delay = 0.5 * (attempt + 1)
-                logger.debug(f"Attente de {delay}s avant la prochaine tentative")
-                time.sleep(delay)
-            
-        except Exception as e:
-            if "timeout" in str(e).lower():
-                error_stats['timeout_errors'] += 1
-                error_type = 'timeout_error'
-            else:
-                error_stats['other_errors'] += 1
-                error_type = 'other_error'
-            
-            error_stats['consecutive_errors'] += 1
-            
-            # Enregistrement de l'échec pour ce capteur
-            error_stats['last_reads_by_sensor'][id] = {
-                'timestamp': datetime.now(),
-                'timestamp_local': datetime.now().replace(tzinfo=timezone(local_tz)),
-                'success': False,
-                'error_type': error_type
-            }
-            
-            logger.warning(f"Erreur lecture capteur {id}, tentative {attempt + 1}/{max_retries}: {str(e)}")
-            
-            if attempt < max_retries - 1:
-                delay = 0.5 * (attempt + 1)
-                time.sleep(delay)
+    def _in_loop(self, callback, *args):
+        """Les reconnexions s'exécutent hors de la boucle : les appels au sélecteur y sont renvoyés"""
+        if threading.get_ident() == self.loop_thread:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
 
-    # Toutes les tentatives ont échoué
-    logger.error(f"Échec lecture capteur {id} après {max_retries} tentatives. Stats: CRC={error_stats['crc_errors']}, Timeout={error_stats['timeout_errors']}, Autres={error_stats['other_errors']}")
-    return None
+    def on_socket_open(self, client, userdata, sock):
+        self._in_loop(self.loop.add_reader, sock, client.loop_read)
 
-def process(client, rtu):
-    """Traite tous les capteurs configurés avec gestion améliorée des erreurs"""
-    global base_topic, config, error_stats
+    def on_socket_close(self, client, userdata, sock):
+        self._in_loop(self.loop.remove_reader, sock)
 
-    # Vérification si trop d'erreurs consécutives - reinitialisation de la connexion série
-    if error_stats['consecutive_errors'] >= 10:
-        logger.warning(f"Trop d'erreurs consécutives ({error_stats['consecutive_errors']}), tentative de réinitialisation de la connexion série")
-        try:
-            rtu.close()
-            time.sleep(2)
-            rtu.open()
-            error_stats['consecutive_errors'] = 0
-            logger.info("Connexion série réinitialisée avec succès")
-        except Exception as e:
-            logger.error(f"Échec de la réinitialisation de la connexion série: {e}")
+    def on_socket_register_write(self, client, userdata, sock):
+        self._in_loop(self.loop.add_writer, sock, client.loop_write)
 
-    for i, sensor in enumerate(config['sensors']):
-        if not sensor.get('enabled', True):
-            logger.debug(f"Capteur {sensor['name']} désactivé, passage au suivant")
-            continue
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._in_loop(self.loop.remove_writer, sock)
 
-        logger.debug(f"Lecture du capteur {sensor['name']} (ID: {sensor['device_id']}) - {i+1}/{len([s for s in config['sensors'] if s.get('enabled', True)])}")
-        
-        # Lecture avec retry automatique
-        payload = getPzem004t(rtu, sensor['device_id'])
-        
-        # Délai entre chaque lecture pour éviter les collisions sur le bus
-        time.sleep(0.5)
-        
-        if payload:
-            component_id = sensor['unique_id']
-            topic = f"{base_topic}/{component_id}"
-            client.publish(topic, json.dumps(payload), qos=0, retain=True)
-            logger.info(f"Données publiées pour {sensor['name']} sur {topic}")
-        else:
-            logger.warning(f"Échec de lecture du capteur {sensor['name']} (ID: {sensor['device_id']})")
+    async def misc_loop(self):
+        reconnect_delay = 0  # Première connexion immédiate
+        while True:
+            if reconnect_delay and self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+                reconnect_delay = 1
+                await asyncio.sleep(1)
+                continue
 
-        # Délai plus long entre chaque capteur pour stabiliser la communication
-        if i < len([s for s in config['sensors'] if s.get('enabled', True)]) - 1:  # Pas de délai après le dernier capteur
-            time.sleep(1.5)
-    
-    # Publication des statistiques de monitoring toutes les 10 lectures ou en cas de problème
-    should_publish_monitoring = (
-        error_stats['total_reads'] % 30 == 0 or  # Toutes les 30 lectures
-        error_stats['consecutive_errors'] >= 5 or  # En cas de problèmes
-        error_stats['last_monitoring_publish'] is None or  # Premier envoi
-        (datetime.now() - error_stats['last_monitoring_publish']).total_seconds() > 300  # Toutes les 5 minutes minimum
-    )
-    
-    if should_publish_monitoring and error_stats['total_reads'] > 0:
-        publish_monitoring_stats(client)
-    
-    # Log des statistiques d'erreurs périodiquement (moins fréquent maintenant)
-    if error_stats['total_reads'] % 100 == 0 and error_stats['total_reads'] > 0:
-        success_rate = round((error_stats['total_reads'] - error_stats['crc_errors'] - error_stats['timeout_errors'] - error_stats['other_errors']) / error_stats['total_reads'] * 100, 2)
-        logger.info(f"Statistiques locales: {error_stats['total_reads']} lectures totales, {success_rate}% de succès, CRC errors: {error_stats['crc_errors']}, Timeouts: {error_stats['timeout_errors']}")
+            # Pas de session : (re)connexion avec backoff exponentiel, dans un thread
+            # pour que le timeout de connexion de paho ne bloque pas les bus
+            await asyncio.sleep(reconnect_delay)
+            try:
+                if reconnect_delay:
+                    logger.info("Tentative de reconnexion au broker MQTT")
+                await self.loop.run_in_executor(None, self.client.reconnect)
+                reconnect_delay = reconnect_delay or 1
+            except Exception as e:
+                if reconnect_delay:
+                    logger.warning(f"Échec de la reconnexion MQTT: {e}")
+                else:
+                    logger.warning(f"Broker MQTT injoignable au démarrage: {e}")
+                reconnect_delay = min(reconnect_delay * 2, 60) or 1
 
-def sendDiscoveryConfig(client, sensor):
-    """Envoie la configuration de découverte pour un capteur"""
-    unique_id = f"{sensor['unique_id']}_energy"
-    topic_state = f"{base_topic}/{sensor['unique_id']}"
-    topic_config = f"{discovery_topic}/sensor/{sensor['unique_id']}/energy/config"
-
-    payload = {
-        "name": "energy",
-        "state_topic": topic_state,
-        "value_template": "{{ value_json.energy }}",
-        "unit_of_measurement": "kWh",
-        "device_class": "energy",
-        "unique_id": unique_id,
-        "object_id": unique_id,
-        "json_attributes_topic": topic_state,
-        "device": {
-            "identifiers": [unique_id],
-            "name": sensor['name'],
-            "manufacturer": "Mamath",
-            "model": "PZEM-004T v3.0"
-        },
-        "origin": {
-            "name": "pzem2mqtt",
-            "url": "https://github.com/Mamath2000/pzem2mqtt.git"
-        },
+# Entités Home Assistant de chaque capteur :
+# (champ, nom, unité, device_class, state_class, précision affichée)
+DISCOVERY_ENTITIES = [
+    ('energy', 'energy', 'kWh', 'energy', 'total_increasing', 3),
+    ('power', 'power', 'W', 'power', 'measurement', 1),
+    ('voltage', 'voltage', 'V', 'voltage', 'measurement', 1),
+    ('current', 'current', 'A', 'current', 'measurement', 3),
+    ('facteur_de_puiss', 'power factor', None, 'power_factor', 'measurement', 2),
+    ('frequency', 'frequency', 'Hz', 'frequency', 'measurement', 1),
+    ('apparent_power', 'apparent power', 'VA', 'apparent_power', 'measurement', 1)
+]
+
+# Entités Home Assistant du monitoring : (clé, nom, template, unité, icône)
+MONITORING_ENTITIES = [
+    ('monitoring', 'success rate', '{{ value_json.success_rate_percent }}', '%', 'mdi:chart-line'),
+    ('health', 'health status', '{{ value_json.health_status }}', None, 'mdi:heart-pulse'),
+    ('reads_per_minute', 'reads per minute', '{{ value_json.reads_per_minute }}', 'reads/min', 'mdi:speedometer'),
+    ('consecutive_errors', 'consecutive errors', '{{ value_json.errors.consecutive_errors }}', None, 'mdi:alert-circle'),
+    ('publish_queue', 'publish queue depth', '{{ value_json.publish_queue.depth }}', None, 'mdi:tray-full')
+]
+
+DISCOVERY_ORIGIN = {
+    "name": "pzem2mqtt",
+    "url": "https://github.com/Mamath2000/pzem2mqtt.git"
+}
+
+def discovery_payloads(sensor):
+    """Configurations de découverte d'un capteur, une entité par grandeur mesurée, indexées par topic"""
+    # Home Assistant ne sait pas décoder les payloads MessagePack / CBOR
+    if payload_encoder.binary:
+        return {}
+
+    topic_state, field_topics = payload_encoder.topics(sensor)
+    per_field = payload_encoder.format == 'fields'
+    device = {
+        # Identifiant historique (entité energy seule) conservé pour ne pas recréer l'appareil
+        "identifiers": [f"{sensor['unique_id']}_energy"],
+        "name": sensor['name'],
+        "manufacturer": "Mamath",
+        "model": "PZEM-004T v3.0"
+    }
+
+    payloads = {}
+    for field, name, unit, device_class, state_class, precision in DISCOVERY_ENTITIES:
+        unique_id = f"{sensor['unique_id']}_{field}"
+        payload = {
+            "name": name,
+            "state_topic": topic_state,
+            "value_template": "{{ value_json." + field + " }}",
+            "device_class": device_class,
+            "state_class": state_class,
+            "suggested_display_precision": precision,
+            "unique_id": unique_id,
+            "object_id": unique_id,
+            "availability_topic": lwt_topic,
+            "device": device,
+            "origin": DISCOVERY_ORIGIN
+        }
+        if unit is not None:
+            payload["unit_of_measurement"] = unit
+        if per_field:
+            # Un topic par grandeur, valeur seule : ni template ni attributs JSON
+            payload["state_topic"] = field_topics[PayloadEncoder.FIELDS.index(field)]
+            del payload["value_template"]
+        elif field == 'energy':
+            payload["json_attributes_topic"] = topic_state
+        payloads[f"{discovery_topic}/sensor/{sensor['unique_id']}/{field}/config"] = payload
+    return payloads
+
+def monitoring_discovery_payloads():
+    """Configurations de découverte de l'appareil de monitoring, indexées par topic"""
+    device = {
+        "identifiers": [f"{monitoring_id}_system"],
+        "name": f"PZEM2MQTT System {node_id}" if cluster is not None else "PZEM2MQTT System",
+        "manufacturer": "Mamath",
+        "model": "PZEM2MQTT Monitor",
+        "sw_version": "1.1"
     }
 
-    client.publish(topic_config, json.dumps(payload), qos=0, retain=True)
-    logger.info(f"Configuration de découverte envoyée pour {sensor['name']}")
+    payloads = {}
+    for key, name, template, unit, icon in MONITORING_ENTITIES:
+        unique_id = f"{monitoring_id}_{key}"
+        payload = {
+            "name": name,
+            "state_topic": monitoring_topic,
+            "value_template": template,
+            "icon": icon,
+            "entity_category": "diagnostic",
+            "unique_id": unique_id,
+            "object_id": unique_id,
+            "availability_topic": lwt_topic,
+            "device": device,
+            "origin": DISCOVERY_ORIGIN
+        }
+        if unit is not None:
+            payload["unit_of_measurement"] = unit
+        if key == 'monitoring':
+            payload["json_attributes_topic"] = monitoring_topic
+        payloads[f"{discovery_topic}/sensor/{monitoring_id}_system/{key}/config"] = payload
+    return payloads
+
+def load_discovery_cache():
+    """Recharge les empreintes des configurations de découverte déjà retenues par le broker"""
+    try:
+        with open(discovery_cache_path, 'r') as f:
+            discovery_cache.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.warning(f"Cache de découverte illisible ({discovery_cache_path}), republication complète: {e}")
+
+def save_discovery_cache():
+    """Enregistre les empreintes de découverte (écriture atomique)"""
+    try:
+        with open(discovery_cache_path + '.tmp', 'w') as f:
+            json.dump(discovery_cache, f, indent=1, sort_keys=True)
+        os.replace(discovery_cache_path + '.tmp', discovery_cache_path)
+    except OSError as e:
+        logger.warning(f"Impossible d'enregistrer le cache de découverte: {e}")
+
+def publish_discovery(topic, payload, force=False):
+    """Publie une configuration de découverte si son empreinte diffère de la dernière publiée"""
+    message = json.dumps(payload, sort_keys=True)
+    digest = hashlib.sha256(message.encode()).hexdigest()
+    if not force and discovery_cache.get(topic) == digest:
+        return False
+
+    # Empreinte mémorisée à l'acquittement : un message perdu (broker absent, débordement
+    # de la file) sera republié au prochain passage
+    publish_queue.put(topic, message, qos=0, retain=True, on_published=lambda: record_discovery(topic, digest))
+    return True
+
+def record_discovery(topic, digest):
+    """Publication de découverte acquittée : empreinte enregistrée (None : configuration supprimée)"""
+    if digest is None:
+        discovery_cache.pop(topic, None)
+    else:
+        discovery_cache[topic] = digest
+    save_discovery_cache()
+
+def sendDiscoveryConfig(client, sensor, force=False):
+    """Envoie la configuration de découverte pour un capteur"""
+    sent = sum(publish_discovery(topic, payload, force) for topic, payload in discovery_payloads(sensor).items())
+    if sent:
+        logger.info(f"Configuration de découverte envoyée pour {sensor['name']} ({sent} entités)")
+    return sent
+
+def setup_discovery_configs(client, force=False):
+    """
+    Configure la découverte automatique pour tous les capteurs activés et le monitoring.
 
-def setup_discovery_configs(client):
-    """Configure la découverte automatique pour tous les capteurs activés"""
+    Seules les configurations modifiées depuis la dernière publication sont envoyées
+    (toutes si force) ; celles des capteurs retirés sont effacées. En mode cluster,
+    chaque nœud annonce les capteurs des bus qu'il interroge.
+    """
     if not auto_discovery:
         logger.info("Auto-découverte désactivée")
         return
+    if payload_encoder.binary:
+        logger.warning(f"Format de payload {payload_encoder.format} illisible par Home Assistant : seul le monitoring est annoncé")
 
+    expected = set()
+    sent = 0
+    running = {bus['name'] for bus in buses}
     for sensor in config['sensors']:
         if sensor.get('enabled', True):
-            sendDiscoveryConfig(client, sensor)
+            expected.update(discovery_payloads(sensor))
+            if cluster is None or sensor.get('bus', 'default') in running:
+                sent += sendDiscoveryConfig(client, sensor, force)
 
-# def setup_monitoring_discovery(client):
-#     """Configure la découverte automatique pour le monitoring"""
-#     if not auto_discovery:
-#         return
-    
-#     monitoring_config = {
-#         "name": "PZEM2MQTT Monitoring",
-#         "state_topic": monitoring_topic,
-#         "value_template": "{{ value_json.success_rate_percent }}",
-#         "unit_of_measurement": "%",
-#         "icon": "mdi:chart-line",
-#         "unique_id": "pzem2mqtt_monitoring",
-#         "object_id": "pzem2mqtt_monitoring",
-#         "json_attributes_topic": monitoring_topic,
-#         "device": {
-#             "identifiers": ["pzem2mqtt_system"],
-#             "name": "PZEM2MQTT System",
-#             "manufacturer": "Mamath",
-#             "model": "PZEM2MQTT Monitor",
-#             "sw_version": "1.1"
-#         },
-#         "origin": {
-#             "name": "pzem2mqtt",
-#             "url": "https://github.com/Mamath2000/pzem2mqtt.git"
-#         }
-#     }
-    
-#     monitoring_discovery_topic = f"{discovery_topic}/sensor/pzem2mqtt_system/monitoring/config"
-#     client.publish(monitoring_discovery_topic, json.dumps(monitoring_config), qos=0, retain=True)
-#     logger.info("Configuration de découverte pour le monitoring envoyée")
+    monitoring_payloads = monitoring_discovery_payloads()
+    expected.update(monitoring_payloads)
+    sent += sum(publish_discovery(topic, payload, force) for topic, payload in monitoring_payloads.items())
+
+    # Entités d'un capteur retiré ou désactivé : config retenue vide pour les supprimer de Home Assistant
+    removed = [topic for topic in discovery_cache if topic not in expected]
+    for topic in removed:
+        publish_queue.put(topic, "", qos=0, retain=True, on_published=lambda topic=topic: record_discovery(topic, None))
+    if removed:
+        logger.info(f"{len(removed)} configuration(s) de découverte supprimée(s)")
+
+    if not sent and not removed:
+        logger.info("Configurations de découverte inchangées")
+
+def forget_discovery(sensors):
+    """Oublie les empreintes de capteurs repris par un autre nœud : elles seront republiées s'ils reviennent"""
+    for sensor in sensors:
+        for topic in discovery_payloads(sensor):
+            discovery_cache.pop(topic, None)
+    save_discovery_cache()
+
+def on_homeassistant_status(client, userdata, message):
+    """Message de naissance Home Assistant : republication complète de la découverte"""
+    # Un statut retenu n'est pas un redémarrage de Home Assistant
+    if message.retain or message.payload != b"online":
+        return
+    logger.info("Home Assistant en ligne, republication de la découverte")
+    setup_discovery_configs(client, force=True)
 
 def publish_monitoring_stats(client):
     """Publie les statistiques de monitoring sur MQTT"""
     global error_stats, monitoring_topic
-    
+
     now = datetime.now()
     session_duration = (now - error_stats['session_start']).total_seconds()
     
@@ -341,20 +2646,28 @@ def publish_monitoring_stats(client):
     
     # Préparation des informations par capteur
     sensors_status = {}
+    bus_schedulers = {bus['name']: bus.get('scheduler') for bus in buses}
+    bus_breakers = {bus['name']: bus.get('breakers', {}) for bus in buses}
+    now_monotonic = time.monotonic()
     for sensor in config['sensors']:
         sensor_id = sensor['device_id']
-        if sensor_id in error_stats['last_reads_by_sensor']:
-            last_read_info = error_stats['last_reads_by_sensor'][sensor_id]
-            sensors_status[f"sensor_{sensor_id}"] = {
+        bus_name = sensor.get('bus', 'default')
+        # Mode cluster : les capteurs des bus interrogés par d'autres nœuds figurent dans leur monitoring
+        if cluster is not None and bus_name not in bus_schedulers:
+            continue
+        status_key = sensor_status_key(bus_name, sensor_id)
+        if (bus_name, sensor_id) in error_stats['last_reads_by_sensor']:
+            last_read_info = error_stats['last_reads_by_sensor'][(bus_name, sensor_id)]
+            sensors_status[status_key] = {
                 "name": sensor['name'],
                 "last_read_timestamp": last_read_info['timestamp'].isoformat(),
-                "last_read_local": last_read_info['timestamp_local'].strftime("%Y-%m-%d %H:%M:%S %Z"),
+                "last_read_local": last_read_info['timestamp'].replace(tzinfo=local_zone).strftime("%Y-%m-%d %H:%M:%S %Z"),
                 "last_read_success": last_read_info['success'],
                 "error_type": last_read_info.get('error_type', None) if not last_read_info['success'] else None,
                 "enabled": sensor.get('enabled', True)
             }
         else:
-            sensors_status[f"sensor_{sensor_id}"] = {
+            sensors_status[status_key] = {
                 "name": sensor['name'],
                 "last_read_timestamp": None,
                 "last_read_local": "Jamais lu",
@@ -362,7 +2675,46 @@ def publish_monitoring_stats(client):
                 "error_type": None,
                 "enabled": sensor.get('enabled', True)
             }
-    
+
+        # État du disjoncteur du capteur
+        breaker = bus_breakers.get(bus_name, {}).get(sensor_id)
+        if breaker is not None:
+            sensors_status[status_key]["breaker"] = breaker.stats(now_monotonic)
+
+        # Ordonnancement du capteur : intervalle, priorité, retard et échéances manquées
+        scheduler = bus_schedulers.get(bus_name)
+        if scheduler is not None and sensor_id in scheduler.stats:
+            schedule_stats = scheduler.stats[sensor_id]
+            sensors_status[status_key]["schedule"] = {
+                "poll_interval": SensorScheduler.interval(sensor),
+                "priority": sensor.get('priority', 0),
+                "polls": schedule_stats['polls'],
+                "missed_deadlines": schedule_stats['missed_deadlines'],
+                "last_lag_s": round(schedule_stats['last_lag_s'], 3) if schedule_stats['last_lag_s'] is not None else None,
+                "max_lag_s": round(schedule_stats['max_lag_s'], 3)
+            }
+
+    # Statistiques de cycle par bus
+    buses_status = {}
+    for bus in buses:
+        bus_stats = bus['stats']
+        buses_status[bus['name']] = {
+            "port": bus['port'],
+            "transport": bus['link'],
+            "gateway": gateways[(bus['host'], bus['tcp_port'])]['stream'].stats if (bus.get('host'), bus.get('tcp_port')) in gateways else None,
+            "sensors": len(bus['sensors']),
+            "polls": bus_stats['polls'],
+            "last_poll_s": round(bus_stats['last_poll_s'], 3) if bus_stats['last_poll_s'] is not None else None,
+            "avg_poll_s": round(bus_stats['avg_poll_s'], 3) if bus_stats['avg_poll_s'] is not None else None,
+            "max_poll_s": round(bus_stats['max_poll_s'], 3),
+            "missed_deadlines": bus_stats['missed_deadlines'],
+            "last_lag_s": round(bus_stats['last_lag_s'], 3) if bus_stats['last_lag_s'] is not None else None,
+            "avg_lag_s": round(bus_stats['avg_lag_s'], 3),
+            "max_lag_s": round(bus_stats['max_lag_s'], 3),
+            "consecutive_errors": bus_stats['consecutive_errors'],
+            "timing": bus['timing'].stats() if 'timing' in bus else None
+        }
+
     monitoring_data = {
         "timestamp": now.isoformat(),
         "session_duration_minutes": round(session_duration / 60, 1),
@@ -375,85 +2727,591 @@ def publish_monitoring_stats(client):
             "other_errors": error_stats['other_errors'],
             "consecutive_errors": error_stats['consecutive_errors']
         },
+        "publish": {
+            "published_messages": error_stats['published_messages'],
+            "suppressed_messages": error_stats['suppressed_messages'],
+            "aggregates_published": error_stats['aggregates_published']
+        },
+        "publish_queue": {
+            "depth": len(publish_queue.items),
+            "inflight": len(publish_queue.inflight),
+            "policy": publish_queue.policy,
+            "enqueued": publish_queue.stats['enqueued'],
+            "published": publish_queue.stats['published'],
+            "dropped": publish_queue.stats['dropped'],
+            "coalesced": publish_queue.stats['coalesced']
+        },
+        "spool": {
+            "depth": spool.depth,
+            "stored": spool.stats['stored'],
+            "dropped": spool.stats['dropped'],
+            "replayed": spool.stats['replayed'],
+            "last_replay_rate_per_s": spool.stats['last_replay_rate']
+        } if spool is not None else None,
+        "history": dict(history.stats) if history is not None else None,
+        "cluster": cluster.status(time.monotonic()) if cluster is not None else None,
+        "config_reload": {
+            "reloads": reload_stats['reloads'],
+            "failures": reload_stats['failures'],
+            "last_reload": reload_stats['last_reload'].isoformat() if reload_stats['last_reload'] else None,
+            "last_changes": reload_stats['last_changes']
+        },
+        "startup": {
+            "buses_ready_s": startup_stats['buses_ready_s'],
+            "mqtt_connected_s": startup_stats['mqtt_connected_s'],
+            "first_publish_s": startup_stats['first_publish_s']
+        },
         "last_successful_read": error_stats['last_successful_read'].isoformat() if error_stats['last_successful_read'] else None,
         "health_status": "healthy" if error_stats['consecutive_errors'] < 5 else "degraded" if error_stats['consecutive_errors'] < 10 else "critical",
         "enabled_sensors": len([s for s in config['sensors'] if s.get('enabled', True)]),
         "total_sensors": len(config['sensors']),
-        "sensors_status": sensors_status
+        "sensors_status": sensors_status,
+        "buses": buses_status
     }
     
     # Publication des statistiques
-    client.publish(monitoring_topic, json.dumps(monitoring_data), qos=1, retain=True)
+    publish_queue.put(monitoring_topic, monitoring_data, qos=1, retain=True)
     error_stats['last_monitoring_publish'] = now
     
     logger.info(f"Statistiques de monitoring publiées: {success_rate}% succès, {error_stats['consecutive_errors']} erreurs consécutives, statut: {monitoring_data['health_status']}")
 
-def main():
+# ==================================================================
+# Rechargement à chaud de la configuration
+# ==================================================================
+
+# Paramètres d'un bus dont la modification impose la réouverture du port
+BUS_SETTINGS = ('link', 'port', 'baudrate', 'timeout', 'driver')
+
+# Sections appliquées uniquement au démarrage
+RESTART_SECTIONS = ('mqtt', 'spool', 'metrics', 'history', 'cluster')
+
+reload_lock = None  # asyncio.Lock créé par init_loop_state
+reload_tasks = set()
+reload_stats = {
+    'reloads': 0,
+    'failures': 0,
+    'last_reload': None,
+    'last_changes': None
+}
+
+def start_bus(client, bus):
+    """Planifie les capteurs d'un bus ouvert et démarre sa tâche de polling"""
+    loop = asyncio.get_running_loop()
+    bus['scheduler'] = SensorScheduler(bus['sensors'], loop.time())
+    bus['task'] = loop.create_task(bus_worker(client, bus))
+
+async def stop_bus(bus):
+    """Arrête la tâche de polling d'un bus et libère son port série"""
+    bus['task'].cancel()
+    try:
+        await bus['task']
+    except asyncio.CancelledError:
+        pass
+    for command in bus['commands']:
+        if 'future' in command:
+            command['future'].cancel()
+    await close_bus(bus)
+
+def apply_config(new_config):
+    """Remplace la configuration courante et les variables globales qui en dérivent"""
+    global config, auto_discovery
+    global local_tz, local_zone, poll_interval, publish_config, breaker_config, aggregation_config
+
+    # Lecture complète avant toute affectation : une configuration invalide ne modifie rien
+    values = {
+        'log_level': getattr(logging, new_config['general'].get('log_level', 'INFO').upper()),
+        'auto_discovery': new_config['mqtt']['auto_discovery'],
+        'local_tz': new_config['general']['local_tz'],
+        'poll_interval': new_config['general']['poll_interval'],
+        'sensors': [(sensor['device_id'], sensor['unique_id'], sensor['name']) for sensor in new_config['sensors']]
+    }
+    zone = timezone(values['local_tz'])
+
+    config = new_config
+    logger.setLevel(values['log_level'])
+    auto_discovery = values['auto_discovery']
+    local_tz = values['local_tz']
+    local_zone = zone
+    payload_encoder.set_zone(zone)
+    poll_interval = values['poll_interval']
+    publish_config = new_config.get('publish', {})
+    breaker_config = new_config.get('circuit_breaker', {})
+    aggregation_config = new_config.get('aggregation', {})
+
+def update_bus_sensors(bus, sensors, now, reset_breakers):
+    """Applique au planning d'un bus en cours de polling sa nouvelle liste de capteurs"""
+    scheduler = bus['scheduler']
+    current = {sensor['device_id']: sensor for sensor in bus['sensors']}
+    wanted = {sensor['device_id']: sensor for sensor in sensors}
+
+    for device_id in current.keys() - wanted.keys():
+        scheduler.remove(device_id)
+        bus['breakers'].pop(device_id, None)
+
+    for device_id, sensor in wanted.items():
+        if device_id not in current:
+            scheduler.add(sensor, now)
+        elif current[device_id] != sensor:
+            scheduler.update(sensor, now)
+        if device_id not in current or reset_breakers:
+            bus['breakers'][device_id] = make_breaker()
+
+    bus['sensors'] = sensors
+
+def enabled_sensors(sensors):
+    """Capteurs activés, indexés par unique_id"""
+    return {sensor['unique_id']: sensor for sensor in sensors if sensor.get('enabled', True)}
+
+async def reload_config(client):
+    """Recharge la configuration et n'applique que les différences à l'état courant"""
+    async with reload_lock:
+        old_config = config
+        try:
+            # Bus et découverte construits depuis la nouvelle configuration avant de toucher
+            # à l'état courant : une configuration invalide ne modifie rien
+            new_config = load_config()
+            desired = {bus['name']: bus for bus in build_buses(source=new_config)}
+            for sensor in enabled_sensors(new_config['sensors']).values():
+                discovery_payloads(sensor)
+            apply_config(new_config)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            reload_stats['failures'] += 1
+            logger.error(f"Rechargement de la configuration refusé, configuration courante conservée: {e}")
+            return
+
+        try:
+            await apply_reload(client, old_config, desired)
+        except Exception as e:
+            reload_stats['failures'] += 1
+            logger.exception(f"Échec de l'application de la configuration rechargée: {e}")
+
+async def apply_reload(client, old_config, desired):
+    """Applique une configuration validée : capteurs, découverte puis bus ajoutés, modifiés ou retirés"""
+    for section in RESTART_SECTIONS:
+        if config.get(section) != old_config.get(section):
+            logger.warning(f"Section '{section}' modifiée : prise en compte au prochain redémarrage")
+
+    changes = {'sensors_added': 0, 'sensors_updated': 0, 'sensors_removed': 0,
+               'buses_started': 0, 'buses_stopped': 0}
+
+    # Capteurs : état de publication et d'agrégation remis à zéro pour ceux qui changent
+    old_sensors = enabled_sensors(old_config['sensors'])
+    new_sensors = enabled_sensors(config['sensors'])
+    if config.get('aggregation') != old_config.get('aggregation'):
+        aggregators.clear()
+    for unique_id, sensor in old_sensors.items():
+        if new_sensors.get(unique_id) != sensor:
+            last_published.pop(unique_id, None)
+            aggregators.pop(unique_id, None)
+        if unique_id not in new_sensors:
+            changes['sensors_removed'] += 1
+    for unique_id, sensor in new_sensors.items():
+        if old_sensors.get(unique_id) != sensor:
+            changes['sensors_added' if unique_id not in old_sensors else 'sensors_updated'] += 1
+
+    # Découverte : seules les configurations dont l'empreinte change sont republiées
+    setup_discovery_configs(client)
+
+    # Bus : réouverture seulement si le port ou ses paramètres changent
+    loop = asyncio.get_running_loop()
+    reset_breakers = config.get('circuit_breaker') != old_config.get('circuit_breaker')
+    if cluster is not None:
+        # Mode cluster : les nouveaux bus sont annoncés puis répartis par rebalance_cluster
+        running = {bus['name'] for bus in buses}
+        desired = {name: bus for name, bus in desired.items() if name in running}
+        cluster.configured = None
+        cluster.changed.set()
+    for bus in list(buses):
+        target = desired.get(bus['name'])
+        if target is not None and all(target[key] == bus[key] for key in BUS_SETTINGS):
+            update_bus_sensors(bus, target['sensors'], loop.time(), reset_breakers)
+            del desired[bus['name']]
+            continue
+        logger.info(f"Arrêt du bus {bus['name']} ({bus['port']})")
+        await stop_bus(bus)
+        buses.remove(bus)
+        changes['buses_stopped'] += 1
+
+    for bus in desired.values():
+        try:
+            await loop.run_in_executor(None, open_bus, bus)
+        except Exception as e:
+            logger.error(f"Impossible d'ouvrir le bus {bus['name']} ({bus['port']}): {e}")
+            continue
+        buses.append(bus)
+        start_bus(client, bus)
+        changes['buses_started'] += 1
+
+    reload_stats['reloads'] += 1
+    reload_stats['last_reload'] = datetime.now()
+    reload_stats['last_changes'] = changes
+    logger.info(f"Configuration rechargée : {changes}")
+
+def request_reload(client):
+    """Déclenche un rechargement de la configuration (SIGHUP ou commande MQTT)"""
+    task = asyncio.get_running_loop().create_task(reload_config(client))
+    reload_tasks.add(task)
+    task.add_done_callback(reload_tasks.discard)
+
+def on_reload_command(client, userdata, message):
+    """Commande MQTT de rechargement de la configuration"""
+    # Un message retenu rejouerait le rechargement à chaque reconnexion
+    if message.retain:
+        return
+    logger.info(f"Rechargement de la configuration demandé sur {message.topic}")
+    request_reload(client)
+
+# ==================================================================
+# Mode cluster : répartition des bus entre plusieurs instances
+# ==================================================================
+
+# Délai avant d'annoncer de nouveau un bus qui n'a pas pu être ouvert [s]
+CLUSTER_REOPEN_DELAY = 60
+# Attente des baux retenus des pairs avant la première répartition [s]
+CLUSTER_SETTLE_DELAY = 1.0
+
+def rendezvous_score(node, bus_name):
+    """Score de hachage de rendez-vous d'un couple (nœud, bus), identique sur tous les nœuds"""
+    return int.from_bytes(hashlib.sha256(f"{node}/{bus_name}".encode()).digest()[:8], 'big')
+
+class ClusterMembership:
+    """
+    Vue du cluster depuis ce nœud. Chaque nœud publie un bail retenu sur
+    {cluster_topic}/{node_id}/lease, renouvelé à chaque heartbeat : bus qu'il sait
+    joindre et bus qu'il interroge. Un pair est vivant tant que son LWT n'est pas
+    offline et que son dernier bail a moins de lease_timeout secondes.
+
+    Chaque bus revient, par hachage de rendez-vous, au nœud vivant de plus haut
+    score parmi ceux qui le joignent : tous les nœuds calculent la même
+    répartition, et seuls les bus d'un nœud qui disparaît changent de mains.
+    """
+
+    def __init__(self, node_id, heartbeat_interval=5, lease_timeout=15):
+        self.node_id = node_id
+        self.heartbeat_interval = heartbeat_interval
+        self.lease_timeout = lease_timeout
+        self.peers = {}  # node_id -> {'buses', 'owned', 'seen' (monotonic), 'online'}
+        self.configured = None  # Bus configurés non ouverts, reconstruits après un changement
+        self.failed = {}  # Bus dont l'ouverture a échoué -> instant de l'échec (monotonic)
+        self.changed = asyncio.Event()
+        self.announce = True  # Bail à republier sans attendre le heartbeat (connexion au broker)
+        self.disconnected_since = None
+        self.fenced_peers = set()  # Pairs vivants au moment de la perte du broker
+        self.stats = {'rebalances': 0, 'acquired': 0, 'released': 0, 'last_change': None}
+
+    def update_lease(self, node, lease, retained):
+        """Bail reçu d'un pair : un bail retenu date de son heartbeat, un bail reçu en direct de maintenant"""
+        age = max(0.0, time.time() - lease.get('heartbeat', 0)) if retained else 0.0
+        peer = self.peers.setdefault(node, {'online': True})
+        previous = (peer.get('buses'), peer.get('owned'))
+        peer.update({'buses': set(lease.get('buses', [])), 'owned': set(lease.get('owned', [])),
+                     'seen': time.monotonic() - age})
+        if not retained:
+            peer['online'] = True
+        if previous != (peer['buses'], peer['owned']):
+            self.changed.set()
+
+    def update_lwt(self, node, online):
+        peer = self.peers.setdefault(node, {'buses': set(), 'owned': set(), 'seen': float('-inf')})
+        if peer.get('online') != online:
+            peer['online'] = online
+            logger.info(f"Nœud {node} {'en ligne' if online else 'hors ligne'}")
+            self.changed.set()
+
+    def alive_peers(self, now):
+        """Pairs vivants : LWT online et bail de moins de lease_timeout secondes"""
+        return {node for node, peer in self.peers.items()
+                if peer.get('online', True) and now - peer['seen'] < self.lease_timeout}
+
+    def reachable(self, now):
+        """Bus configurés sur ce nœud, hors échecs d'ouverture récents"""
+        return {name for name in self.configured if now - self.failed.get(name, float('-inf')) >= CLUSTER_REOPEN_DELAY}
+
+    def assignment(self, running, connected, now):
+        """Bus que ce nœud doit interroger"""
+        reachable = self.reachable(now)
+        if not connected:
+            # Broker perdu : la vue est figée, puis les bus que d'autres nœuds connus
+            # peuvent reprendre sont libérés une fois leur bail expiré
+            if self.disconnected_since is None:
+                self.disconnected_since = now
+                self.fenced_peers = self.alive_peers(now)
+            if now - self.disconnected_since < self.lease_timeout:
+                return set(running) & reachable
+            return {name for name in reachable
+                    if not any(name in self.peers[node]['buses'] for node in self.fenced_peers)}
+        self.disconnected_since = None
+
+        alive = self.alive_peers(now)
+        desired = set()
+        for name in reachable:
+            candidates = [node for node in alive if name in self.peers[node]['buses']] + [self.node_id]
+            if max(candidates, key=lambda node: (rendezvous_score(node, name), node)) != self.node_id:
+                continue
+            # Passation : un bus n'est pris qu'une fois libéré par son détenteur encore vivant
+            if name not in running and any(name in self.peers[node]['owned'] for node in alive):
+                continue
+            desired.add(name)
+        return desired
+
+    def lease(self, running, now):
+        return {
+            "node": self.node_id,
+            "buses": sorted(self.reachable(now)),
+            "owned": sorted(running),
+            "heartbeat": round(time.time(), 3),
+            "lease_timeout": self.lease_timeout
+        }
+
+    def status(self, now):
+        """Résumé pour le monitoring"""
+        return {
+            "node": self.node_id,
+            "alive_peers": sorted(self.alive_peers(now)),
+            "owned_buses": sorted(bus['name'] for bus in buses),
+            "rebalances": self.stats['rebalances'],
+            "acquired": self.stats['acquired'],
+            "released": self.stats['released'],
+            "last_change": self.stats['last_change']
+        }
+
+def on_cluster_message(client, userdata, message):
+    """Bail ou LWT d'un nœud du cluster"""
+    node, kind = message.topic[len(cluster_topic) + 1:].split('/')
+    if node == cluster.node_id:
+        return
+    if kind == 'lwt':
+        cluster.update_lwt(node, message.payload == b"online")
+        return
+    if not message.payload:
+        cluster.peers.pop(node, None)
+        cluster.changed.set()
+        return
+    try:
+        cluster.update_lease(node, json.loads(message.payload), message.retain)
+    except (ValueError, TypeError, AttributeError) as e:
+        logger.warning(f"Bail de cluster invalide sur {message.topic}: {e}")
+
+async def rebalance_cluster(client):
+    """Arrête les bus attribués à un autre nœud et démarre ceux qui reviennent à celui-ci"""
+    loop = asyncio.get_running_loop()
+    async with reload_lock:
+        if cluster.configured is None:
+            cluster.configured = {bus['name']: bus for bus in build_buses()}
+        now = time.monotonic()
+        running = {bus['name']: bus for bus in buses}
+        desired = cluster.assignment(running, client.is_connected(), now)
+        changed = False
+        acquired = []
+
+        for name, bus in running.items():
+            if name in desired:
+                continue
+            logger.info(f"Bus {name} ({bus['port']}) confié à un autre nœud, arrêt du polling")
+            await stop_bus(bus)
+            buses.remove(bus)
+            forget_discovery(bus['sensors'])
+            # Un bus fermé n'est pas réutilisé : il sera reconstruit s'il revient
+            cluster.configured = None
+            cluster.stats['released'] += 1
+            changed = True
+        if cluster.configured is None:
+            cluster.configured = {bus['name']: bus for bus in build_buses()}
+
+        for name in desired - running.keys():
+            bus = cluster.configured[name]
+            try:
+                await loop.run_in_executor(None, open_bus, bus)
+            except Exception as e:
+                # Bus retiré de l'annonce : un autre nœud qui le joint pourra le reprendre
+                logger.error(f"Impossible d'ouvrir le bus {name} ({bus['port']}): {e}")
+                cluster.failed[name] = now
+                changed = True
+                continue
+            logger.info(f"Bus {name} ({bus['port']}) attribué à ce nœud, démarrage du polling")
+            buses.append(bus)
+            start_bus(client, bus)
+            acquired.extend(bus['sensors'])
+            cluster.stats['acquired'] += 1
+            changed = True
+
+        cluster.stats['rebalances'] += 1
+        if changed:
+            cluster.stats['last_change'] = datetime.now().isoformat()
+            # La découverte retenue d'un bus repris désigne la disponibilité du nœud précédent,
+            # même si le cache local (antérieur à un arrêt brutal) la croit à jour : republication
+            if acquired:
+                forget_discovery(acquired)
+            setup_discovery_configs(client)
+        return changed
+
+async def run_cluster(client):
+    """Heartbeat du bail de ce nœud et répartition des bus à chaque changement du cluster"""
+    def publish_lease():
+        lease = cluster.lease([bus['name'] for bus in buses], time.monotonic())
+        client.publish(f"{cluster_topic}/{cluster.node_id}/lease", json.dumps(lease), qos=1, retain=True)
+        cluster.announce = False
+        return time.monotonic()
+
+    # Premier bail sans bus interrogé : les nœuds démarrés ensemble se voient avant de se répartir les bus
+    cluster.configured = {bus['name']: bus for bus in build_buses()}
+    last_heartbeat = time.monotonic()
+    if client.is_connected():
+        last_heartbeat = publish_lease()
+        await asyncio.sleep(CLUSTER_SETTLE_DELAY)
+    while True:
+        try:
+            await asyncio.wait_for(cluster.changed.wait(), cluster.heartbeat_interval)
+        except asyncio.TimeoutError:
+            pass
+        cluster.changed.clear()
+
+        changed = await rebalance_cluster(client)
+        if client.is_connected() and (changed or cluster.announce or time.monotonic() - last_heartbeat >= cluster.heartbeat_interval):
+            last_heartbeat = publish_lease()
+
+async def main():
 
     global mqtt_host
     global mqtt_port
     global lwt_topic
-    global serial_port
+    global spool
+    global history
+    global cluster
 
     logger.info(" ==== Starting pzem2mqtt 1.0 (mamath) === ")
+    loop = asyncio.get_running_loop()
+    init_loop_state()
 
     # MQTT configuration
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     client.will_set(lwt_topic, "offline", qos=0, retain=True)
     client.on_connect = on_connect
+    client.on_publish = on_publish
+    client.on_disconnect = on_disconnect
+    client.message_callback_add(f"{command_topic}/reload", on_reload_command)
+    client.message_callback_add(f"{command_topic}/scan", on_scan_command)
+    client.message_callback_add(f"{command_topic}/+/+", on_sensor_command)
+    client.message_callback_add(f"{discovery_topic}/status", on_homeassistant_status)
 
-    logger.info("Connection to mqtt broker : http://{}:{}".format(mqtt_host, mqtt_port))
+    # Rechargement de la configuration à chaud (systemctl reload) : accepté dès maintenant, mais
+    # le verrou tenu jusqu'au démarrage des bus diffère un rechargement demandé pendant l'attente
+    # du broker et l'ouverture des ports
+    await reload_lock.acquire()
+    loop.add_signal_handler(signal.SIGHUP, request_reload, client)
 
-    # client.on_log = on_log
-    # client.username_pw_set(mqtt_user, mqtt_pwd)
-    client.connect(mqtt_host, mqtt_port, keepalive=120)
-    client.publish(lwt_topic, "online", qos=0, retain=True)
+    if cluster_config.get('enabled', False):
+        cluster = ClusterMembership(node_id, cluster_config.get('heartbeat_interval', 5), cluster_config.get('lease_timeout', 15))
+        client.message_callback_add(f"{cluster_topic}/+/lease", on_cluster_message)
+        client.message_callback_add(f"{cluster_topic}/+/lwt", on_cluster_message)
+        logger.info(f"Mode cluster, nœud {node_id} (bail de {cluster.lease_timeout}s)")
+    load_discovery_cache()
+    # File paho bornée : pendant une coupure, les lectures vont dans le spool disque
+    client.max_queued_messages_set(1000)
+    bridge = AsyncioMqttBridge(client, loop)
 
-    time.sleep(4)
+    if spool_config.get('enabled', False):
+        spool_path = spool_config.get('path', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spool.db'))
+        spool = Spool(spool_path, spool_config.get('max_rows', 100000))
+        logger.info(f"Spool activé ({spool_path}, {spool.depth} messages en attente)")
 
-    # Configuration automatique de la découverte pour tous les capteurs activés
-    setup_discovery_configs(client)
-    
-    # Configuration de la découverte pour le monitoring
-    # setup_monitoring_discovery(client)
+    if history_config.get('enabled', False):
+        history = HistoryRecorder(history_path(), history_config.get('flush_interval', 10), history_config.get('retention_days'))
+        logger.info(f"Historique local activé ({history.path}, {HISTORY_RECORD.size} octets par lecture)")
 
-    time.sleep(2)
+    # En mode cluster, seuls les bus attribués à ce nœud sont ouverts, par run_cluster ;
+    # la configuration de tous les bus est vérifiée avant toute connexion
+    try:
+        configured_buses = build_buses()
+    except ValueError as e:
+        logger.error(f"Configuration des bus invalide: {e}")
+        return
+    if cluster is not None:
+        configured_buses = []
 
-    # Connect to the slave avec paramètres optimisés pour la stabilité
-    serial_connection = serial.Serial(
-                        port=serial_port,
-                        baudrate=9600,
-                        bytesize=8,
-                        parity='N',
-                        stopbits=1,
-                        xonxoff=0,
-                        timeout=3.0,  # Timeout plus long pour éviter les erreurs
-                        write_timeout=2.0
-                        )
+    logger.info("Connection to mqtt broker : http://{}:{}".format(mqtt_host, mqtt_port))
+
+    # client.on_log = on_log
+    # client.username_pw_set(mqtt_user, mqtt_pwd)
+    # Connexion MQTT dans un thread : le délai connect_timeout court dès maintenant,
+    # pendant l'ouverture des ports série
+    connect_deadline = time.monotonic() + mqtt_connect_timeout
+    bridge.start(mqtt_host, mqtt_port, keepalive=120)
 
-    master = modbus_rtu.RtuMaster(serial_connection)
-    master.set_timeout(3.0)  # Timeout Modbus plus long
-    master.set_verbose(True)
+    # Ouverture des ports série (un adaptateur par bus) en parallèle de la connexion MQTT
+    bus_openings = [loop.run_in_executor(None, open_bus, bus) for bus in configured_buses]
 
-    try:
-        master.close()
-    except:
-        pass
+    for bus, result in zip(configured_buses, await asyncio.gather(*bus_openings, return_exceptions=True)):
+        if isinstance(result, Exception):
+            logger.error(f"Impossible d'ouvrir le bus {bus['name']} ({bus['port']}): {result}")
+            continue
+        buses.append(bus)
+    startup_stats['buses_ready_s'] = round(time.monotonic() - startup_stats['started'], 3)
 
-    # Planification avec l'intervalle de polling configuré
-    schedule.every(poll_interval).seconds.do(process, client=client, rtu=master)
+    if not buses and cluster is None:
+        logger.error("Aucun bus série disponible, arrêt")
+        return
 
-    client.loop_start()
+    # Attente de la session MQTT (CONNACK) ; sans broker, le polling démarre quand même
+    try:
+        if not mqtt_connected.is_set():
+            await asyncio.wait_for(mqtt_connected.wait(), max(0, connect_deadline - time.monotonic()))
+    except asyncio.TimeoutError:
+        logger.warning(f"Pas de connexion MQTT après {mqtt_connect_timeout}s, démarrage du polling sans broker")
 
     # Publication initiale des statistiques de monitoring
     publish_monitoring_stats(client)
 
-    process(client, master)
+    if metrics_config.get('enabled', False):
+        metrics_bind = metrics_config.get('bind', '0.0.0.0')
+        metrics_port = metrics_config.get('port', 9105)
+        await asyncio.start_server(handle_metrics_request, metrics_bind, metrics_port)
+        logger.info(f"Métriques Prometheus exposées sur http://{metrics_bind}:{metrics_port}/metrics")
 
-    while True:
-        schedule.run_pending()
-        time.sleep(10)
+    # Une tâche de polling par bus, toutes publient via le même client MQTT
+    for bus in buses:
+        start_bus(client, bus)
+    reload_lock.release()
+
+    # Arrêt du service (systemctl stop) : l'historique est écrit avant de quitter
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+    tasks = [publish_worker(client, publish_queue)]
+    if spool is not None:
+        tasks.append(replay_spool(client))
+    if history is not None:
+        tasks.append(flush_history(history))
+    if cluster is not None:
+        tasks.append(run_cluster(client))
+    try:
+        await asyncio.gather(*tasks)
+    except asyncio.CancelledError:
+        logger.info("Arrêt de pzem2mqtt")
+    finally:
+        if history is not None:
+            history.close()
 
 if __name__ == "__main__":
 
-    main()
+    parser = argparse.ArgumentParser(description="Lecture des PZEM-004T et publication MQTT")
+    parser.add_argument('--scan', action='store_true', help="Recherche les adresses présentes sur tous les bus configurés puis quitte (service arrêté)")
+    parser.add_argument('--first', type=int, default=scan_config.get('first', 1), help="Première adresse sondée (défaut 1)")
+    parser.add_argument('--last', type=int, default=scan_config.get('last', 247), help="Dernière adresse sondée (défaut 247)")
+    parser.add_argument('--generate', action='store_true', help="Ajoute à config.json les capteurs trouvés et non configurés")
+    parser.add_argument('--export', metavar='UNIQUE_ID', help="Exporte en CSV l'historique local d'un capteur puis quitte")
+    parser.add_argument('--from', dest='start', help="Début de l'export : date ISO (heure locale) ou epoch (défaut : 24 h avant --to)")
+    parser.add_argument('--to', dest='end', help="Fin de l'export, exclue (défaut : maintenant)")
+    parser.add_argument('--step', type=float, default=0, help="Sous-échantillonnage en fenêtres de STEP secondes (défaut : lectures brutes)")
+    parser.add_argument('--output', help="Fichier CSV produit (défaut : sortie standard)")
+    args = parser.parse_args()
+
+    if args.export:
+        end = parse_history_time(args.end) if args.end else time.time()
+        start = parse_history_time(args.start) if args.start else end - 86400
+        with (open(args.output, 'w', newline='') if args.output else contextlib.nullcontext(sys.stdout)) as output:
+            exported = export_history(args.export, start, end, args.step, output)
+        sys.exit(0 if exported else 1)
+    elif args.scan:
+        asyncio.run(scan_cli(args.first, args.last, args.generate))
+    else:
+        asyncio.run(main())
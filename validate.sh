@@ -27,12 +27,15 @@ import json
 with open('config.json', 'r') as f:
     config = json.load(f)
 print(f'   MQTT Host: {config[\"mqtt\"][\"host\"]}:{config[\"mqtt\"][\"port\"]}')
-print(f'   Port série: {config[\"serial\"][\"port\"]}')
+if 'serial' in config:
+    print(f'   Port série: {config[\"serial\"][\"port\"]}')
+for name, bus in config.get('buses', {}).items():
+    print(f'   Bus {name}: {bus[\"port\"]}')
 print(f'   Niveau de log: {config[\"general\"].get(\"log_level\", \"INFO\")}')
 print(f'   Capteurs configurés: {len(config[\"sensors\"])}')
 for i, sensor in enumerate(config['sensors']):
     status = 'activé' if sensor.get('enabled', True) else 'désactivé'
-    print(f'     - {sensor[\"name\"]} (ID: {sensor[\"device_id\"]}) - {status}')
+    print(f'     - {sensor[\"name\"]} (ID: {sensor[\"device_id\"]}, bus: {sensor.get(\"bus\", \"default\")}) - {status}')
 "
 else
     echo "   ✗ config.json invalide"
@@ -41,7 +44,7 @@ fi
 # Vérification des dépendances Python
 echo ""
 echo "4. Vérification des dépendances Python..."
-dependencies=("modbus_tk" "serial" "paho.mqtt.client" "schedule")
+dependencies=("modbus_tk" "serial" "paho.mqtt.client")
 for dep in "${dependencies[@]}"; do
     if python3 -c "import $dep" 2>/dev/null; then
         echo "   ✓ $dep"